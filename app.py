@@ -2,17 +2,22 @@
 # -*- coding: utf-8 -*-
 import gevent.monkey
 gevent.monkey.patch_all()
+import gevent
+import gevent.queue
 
 
 from flask import Flask
 import redis
 from functools import wraps
-from weibo import Client
+from third.weibo2 import Client, ResponseCache
 import uuid, time
 from flask import Markup, Response, request, make_response, abort, redirect, url_for, render_template, g
-from utils.markdown import markdown
+from utils.markdown import Markdown
+from utils.search import index_tokens, query_tokens
+import jobs
 import re
 import json
+import hashlib
 import logging
 #logging.basicConfig(filename='.log', filemode='a', level=logging.DEBUG)
 
@@ -21,20 +26,131 @@ import logging
 app = Flask(__name__, static_folder='assets')
 app.config.from_object("settings")
 
+# converters are safe to share, see Markdown.convert()
+md = Markdown(safe_mode='escape', max_length=app.config['MARKDOWN_MAX_LENGTH'],
+              time_limit=app.config['MARKDOWN_TIME_LIMIT'])
+status_md = Markdown(safe_mode='escape', deterministic=True,
+                     max_length=app.config['MARKDOWN_MAX_LENGTH'],
+                     time_limit=app.config['MARKDOWN_TIME_LIMIT'])
+md.warm_up()
+status_md.warm_up()
+
 def markdown_filter(s):
-    return Markup(markdown(s,safe_mode = 'escape'))
+    return Markup(md.convert(s))
 
 app.jinja_env.filters['markdown'] = markdown_filter
 
+# Bump when a change to utils.markdown or its options changes the HTML, so
+# that statuses stored with the old rendering are rendered again.
+RENDER_VERSION = 1
+
+def render_status(status):
+    """HTML of a status, as stored next to it in `status_html`, and whether
+    the markdown ran out of time: the HTML is then the plain text fallback,
+    to be rendered again with render_later()."""
+    return status_md.convert_checked(status)
+
+def render_later(key, status_html_key):
+    """Have a job render again the status stored on hash `key` with
+    `status_html_key`, meanwhile its plain text fallback is shown."""
+    jobs.enqueue(app.redis, 'render_status', key, key=key, html_key=status_html_key)
+
+def html_key(status):
+    """Which rendering of which text `status_html` holds."""
+    if isinstance(status, unicode) :
+        status = status.encode('utf-8')
+    return '%s:%s'%(RENDER_VERSION, hashlib.sha1(status).hexdigest())
+
 
 app.redis = redis.Redis(host=app.config['REDIS_HOST'], port=app.config['REDIS_PORT'], db=0)
 
+app.weibo_cache = ResponseCache(app.redis, ttls=app.config['WEIBO_CACHE_TTLS'])
+
 def get_client():
-    return Client(app.config['WEIBO_CONSUMER_KEY'], app.config['WEIBO_CONSUMER_SECRET'], app.config['REDIRECT_URI'])
+    return Client(app.config['WEIBO_CONSUMER_KEY'], app.config['WEIBO_CONSUMER_SECRET'], app.config['REDIRECT_URI'],
+                  cache=app.weibo_cache)
 
 app.client = get_client
 
 
+class EventHub(object):
+    """Fans Redis pub/sub events out to the /events streams of this worker.
+
+    A single greenlet holds one subscription for the whole worker, to the
+    channels some stream of this worker listens on, and hands each message
+    to the queues of those streams, so an idle client costs a greenlet and
+    a queue rather than a Redis connection.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.queues = {}
+        self.listener = None
+        self.pubsub = None
+
+    def subscribe(self, channels):
+        queue = gevent.queue.Queue(maxsize=app.config['EVENTS_QUEUE_SIZE'])
+        new = [ channel for channel in channels if channel not in self.queues ]
+        for channel in channels :
+            self.queues.setdefault(channel, set()).add(queue)
+        if self.listener is None :
+            self.listener = gevent.spawn(self._listen)
+        elif new :
+            self._execute('subscribe', new)
+        return queue
+
+    def unsubscribe(self, queue, channels):
+        gone = []
+        for channel in channels :
+            queues = self.queues.get(channel, set())
+            queues.discard(queue)
+            if not queues and self.queues.pop(channel, None) is not None :
+                gone.append(channel)
+        if gone :
+            self._execute('unsubscribe', gone)
+
+    def _execute(self, command, channels):
+        # Sent on the connection the listener reads from. When there is
+        # none yet, or sending fails and breaks it, the listener subscribes
+        # to every channel in self.queues as it connects again.
+        pubsub = self.pubsub
+        if pubsub is None :
+            return
+        try:
+            getattr(pubsub, command)(*channels)
+        except Exception :
+            logging.exception('event %s failed', command)
+
+    def _listen(self):
+        # Runs while any stream listens: whatever goes wrong, the
+        # subscription is dropped and made again, or every stream would be
+        # left with keepalives only.
+        while self.queues :
+            pubsub = self.pubsub = self.redis.pubsub()
+            try:
+                pubsub.subscribe(*self.queues)
+                for message in pubsub.listen() :
+                    if message['type'] != 'message' :
+                        continue
+                    for queue in list(self.queues.get(message['channel'], ())) :
+                        try:
+                            queue.put_nowait(message['data'])
+                        except gevent.queue.Full :
+                            # A stalled client misses events rather than
+                            # growing without bound; it catches up on
+                            # reconnect through the list endpoints.
+                            pass
+            except Exception :
+                logging.exception('event subscription lost, reconnecting')
+                gevent.sleep(1)
+            finally:
+                self.pubsub = None
+                pubsub.close()
+        self.listener = None
+
+app.events = EventHub(app.redis)
+
+
 def access_token(method):
     @wraps(method)
     def wrapper(*args, **kwargs):
@@ -55,6 +171,124 @@ def access_token(method):
     return wrapper
 
 
+def _load_users(user_names):
+    """Fetch the ``user:%s`` hashes for ``user_names`` in a single round trip.
+
+    Duplicate names are fetched once; the result maps name -> user hash.
+    """
+    user_names = list(set(user_names))
+    pipe = app.redis.pipeline(transaction=False)
+    for name in user_names:
+        pipe.hgetall('user:%s'%name)
+    return dict(zip(user_names, pipe.execute()))
+
+
+def _load_conversations(conversation_ids):
+    """Hydrate a page of conversation summaries for the list views.
+
+    The summary counters live in the conversation record itself (see
+    POST_STATUS_SCRIPT), so a page costs one pipelined HGETALL per
+    conversation, together with the current user's unread counters, plus
+    one round trip for the distinct authors. Records
+    written before the counters existed are filled in from the sorted sets.
+    """
+    if not conversation_ids :
+        return []
+    pipe = app.redis.pipeline(transaction=False)
+    for i in conversation_ids :
+        pipe.hgetall('conversation:%s'%i)
+    pipe.hmget('user:%s:unread'%g.user['name'], conversation_ids)
+    replies = pipe.execute()
+    conv = []
+    for i, c, unread in zip(conversation_ids, replies[:-1], replies[-1]) :
+        if not c :
+            continue
+        c['conversation_id'] = i
+        c['unread'] = int(unread or 0)
+        conv.append(c)
+    _decode_summaries(conv)
+    _render_stale(conv, [ 'conversation:%s'%c['conversation_id'] for c in conv ])
+    for c in conv :
+        c['updated_time'] = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(float(c['updated_time'])))
+    users = _load_users(c['user_name'] for c in conv)
+    for c in conv :
+        c['user'] = users[c['user_name']]
+    return conv
+
+
+def _decode_summaries(conv):
+    """Turn the summary fields stored on conversation records into Python
+    values.
+
+    Conversations nobody has posted to since the summary was denormalized
+    lack the fields; those are computed from the sorted sets in one extra
+    round trip, and the next post stores them for good.
+    """
+    legacy = [ c for c in conv if 'status_count' not in c ]
+    if legacy :
+        pipe = app.redis.pipeline(transaction=False)
+        for c in legacy :
+            pipe.zcard('conversation:%s:access'%c['conversation_id'])
+            pipe.zrevrange('conversation:%s:access'%c['conversation_id'],0,4,False)
+            pipe.zcard('conversation:%s:statuses'%c['conversation_id'])
+        replies = pipe.execute()
+        for n, c in enumerate(legacy) :
+            c['conversation_count'], latest_users, c['status_count'] = replies[n*3:n*3+3]
+            c['latest_users'] = json.dumps(latest_users)
+    for c in conv :
+        c['conversation_count'] = int(c['conversation_count'])
+        c['status_count'] = int(c['status_count'])
+        c['latest_users'] = json.loads(c['latest_users'])
+
+
+def _render_stale(records, keys):
+    """Fill in `status_html` on status or conversation records stored
+    before it existed, or rendered by an older RENDER_VERSION, and store it
+    on the hashes at `keys` in one round trip. The whole page is rendered
+    with one markdown call, so a status quoted many times is rendered once."""
+    stale = []
+    for key, r in zip(keys, records) :
+        current = html_key(r['status'])
+        if r.get('html_key') != current :
+            r['html_key'] = current
+            stale.append((key, r))
+        else:
+            r['status_html'] = r['status_html'].decode('utf-8')
+    if not stale :
+        return
+    pipe = app.redis.pipeline(transaction=False)
+    html = status_md.convert_many([ r['status'] for key, r in stale ], checked=True)
+    for (key, r), (status_html, timed_out) in zip(stale, html) :
+        r['status_html'] = status_html
+        pipe.hmset(key, {'status_html': status_html, 'html_key': r['html_key']})
+    pipe.execute()
+    for (key, r), (status_html, timed_out) in zip(stale, html) :
+        if timed_out :
+            render_later(key, r['html_key'])
+
+
+def _load_statuses(status_ids):
+    """Hydrate a page of statuses together with their authors.
+
+    The status hashes come back in one pipelined round trip and the
+    distinct authors in a second one, however many statuses each wrote.
+    """
+    pipe = app.redis.pipeline(transaction=False)
+    for status_id in status_ids :
+        pipe.hgetall('status:%s'%status_id)
+    statuses = []
+    for status_id, s in zip(status_ids, pipe.execute()) :
+        if s :
+            s['status_id'] = status_id
+            statuses.append(s)
+    _render_stale(statuses, [ 'status:%s'%s['status_id'] for s in statuses ])
+    users = _load_users(s['user_name'] for s in statuses)
+    for s in statuses :
+        s['user'] = users[s['user_name']]
+        s['created_time'] = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(float(s['created_time'])))
+    return statuses
+
+
 @app.route('/', methods=['GET'])
 @access_token
 def home():
@@ -62,19 +296,8 @@ def home():
         return render_template('index.html')
     if g.user.get('email','') :
         conversation_list = app.redis.zrange( 'user:%s:conversation_list'%g.user['name'], 0, -1, False )
-        conv = []
-        for i in conversation_list :
-            c = app.redis.hgetall( 'conversation:%s'%i)
-            c['conversation_count'] = app.redis.zcard('conversation:%s:access'%i)
-            c['latest_users'] = app.redis.zrevrange('conversation:%s:access'%i,0,4,False)
-            c['status_count'] = app.redis.zcard('conversation:%s:statuses'%i)
-            c['conversation_id'] = i
-            c['user'] = app.redis.hgetall( 'user:%s'%c['user_name'])
-            c['updated_time'] = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(float(c['updated_time'])))
-            c['user'] = app.redis.hgetall('user:%s'%c['user_name'])
-            conv.append(c)
-        contacts = app.redis.zrange('user:%s:contact'%g.user['name'], 0, -1, False)
-        return render_template('home.html', user=g.user, conv=conv,contacts = contacts)
+        conv = _load_conversations(conversation_list)
+        return render_template('home.html', user=g.user, conv=conv)
     else:
         return redirect('/register')
 
@@ -119,18 +342,8 @@ def _on_login( weibo, c):
     else :
         user_tlz['profile_image_url'] = weibo.get('profile_image_url', None)
     app.redis.hmset('user:%s'%user_tlz['name'], user_tlz )
-    user_contact  = app.redis.zrange('user:%s:contact'%weibo['user_name'], 0, -1, True )
-    if not user_contact :
-        cursor = 0
-        while  True :
-            weibo_contact = c.get("friendships/friends",access_token=weibo['access_token'], uid= weibo['id'], cursor=cursor)
-            logging.info(weibo_contact)
-            cursor = weibo_contact.get('next_cursor', 0)
-            for w in weibo_contact.get('users', []) :
-                app.redis.zadd('user:%s:contact'%weibo['user_name'], w['name'], time.time())
-                app.redis.hmset('weibo:%s'%w['id'], w )
-            if cursor == 0 :
-                break
+    if not app.redis.exists('user:%s:contact'%weibo['user_name']) :
+        jobs.enqueue(app.redis, 'sync_contacts', weibo['user_name'], user_name=weibo['user_name'], weibo_id=weibo['id'])
 
     session = {'access_token':uuid.uuid4().get_hex(), 'created_time': time.time(), 'user_name':user_tlz['name'] }
     app.redis.hmset('session:%s'%session['access_token'], session )
@@ -164,103 +377,364 @@ def logout():
     resp.set_cookie('access_token','')
     return resp
 
+CONTACT_LIMIT = 50
+
 @app.route('/contact',methods=['GET'])
 @access_token
 def contact():
-    contacts = app.redis.zrange('user:%s:contact'%g.user['name'], 0, -1, False)
-    return jsonwrite(contacts)
-
+    """
+    Contacts whose name, full pinyin or pinyin initials start with `q`,
+    case-insensitively, for the @mention typeahead; at most `limit` of them.
+    """
+    try:
+        limit = max(1, min(int(request.args.get('limit', 10)), CONTACT_LIMIT))
+    except ValueError :
+        abort(400)
+    index = jobs.CONTACT_INDEX%g.user['name']
+    if not app.redis.exists(index) :
+        # contacts synced before the index existed
+        names = app.redis.zrange('user:%s:contact'%g.user['name'], 0, -1, False)
+        if names :
+            pipe = app.redis.pipeline(transaction=False)
+            jobs.index_contacts(pipe, g.user['name'], names)
+            pipe.execute()
+    q = request.args.get('q', '').strip().lower().encode('utf-8')
+    if q :
+        lo, hi = '['+q, '['+q+'\xff'
+    else:
+        lo, hi = '-', '+'
+    # a name has up to 17 entries (its own and 8 pinyin spellings with
+    # their initials); read pages of them until `limit` names are found
+    contacts = []
+    offset = 0
+    while len(contacts) < limit :
+        entries = app.redis.zrangebylex(index, lo, hi, offset, limit*4)
+        for e in entries :
+            name = e.split('\0', 1)[1]
+            if name not in contacts :
+                contacts.append(name)
+        if len(entries) < limit*4 :
+            break
+        offset += len(entries)
+    return jsonwrite(contacts[:limit])
+
+
+
+# Posts a status in one atomic step: access check, id allocation, status and
+# conversation writes, list fan-out and mention fan-out. The conversation
+# record also carries the summary the list views show (status_count,
+# conversation_count and latest_users as a JSON list), kept up to date here
+# so that reading a summary is a single HGETALL. Every other participant
+# with an account gets the conversation's counter in user:%s:unread bumped.
+# Finally a 'status' event is published on conversation:%s:events and a
+# 'conversation' event on the user:%s:events channel of every participant
+# (see /events). The status is added to the search:<token> postings that
+# /search reads, each scored with the number of times the token occurs.
+# Status and conversation records keep the rendered HTML next to the text
+# (see render_status), so views never run markdown for new statuses.
+#
+# ARGV: user_name, status, now, now_int, conversation_id ('' for a new
+# conversation), status_html, html_key, number of mentions, mentioned user
+# names..., then token, count pairs...
+# Returns {status_id, conversation_id, mentioned names without an account},
+# or {0} when the poster has no access to the conversation.
+POST_STATUS_SCRIPT = """
+local user_name, status, now, now_int = ARGV[1], ARGV[2], ARGV[3], ARGV[4]
+local conversation_id, status_html, html_key = ARGV[5], ARGV[6], ARGV[7]
+local mentions_end = 8 + tonumber(ARGV[8])
+local joined = 0
+if conversation_id ~= '' then
+    if not redis.call('zscore', 'conversation:' .. conversation_id .. ':access', user_name) then
+        return {0}
+    end
+else
+    conversation_id = tostring(redis.call('incr', 'count:conversation'))
+    joined = joined + redis.call('zadd', 'conversation:' .. conversation_id .. ':access', now_int, user_name)
+end
+local conversation_key = 'conversation:' .. conversation_id
+local status_id = redis.call('incr', 'count:status')
+redis.call('hmset', 'status:' .. status_id,
+    'created_time', now, 'status', status, 'user_name', user_name,
+    'conversation_id', conversation_id, 'status_html', status_html, 'html_key', html_key)
+for i = mentions_end + 1, #ARGV, 2 do
+    redis.call('zadd', 'search:' .. ARGV[i], ARGV[i + 1], status_id)
+end
+redis.call('hmset', conversation_key,
+    'updated_time', now, 'status', status, 'user_name', user_name,
+    'status_html', status_html, 'html_key', html_key)
+redis.call('zadd', 'user:' .. user_name .. ':conversation_list', now, conversation_id)
+redis.call('zadd', conversation_key .. ':statuses', now, status_id)
+local missing = {}
+for i = 9, mentions_end do
+    local name = ARGV[i]
+    joined = joined + redis.call('zadd', conversation_key .. ':access', now_int, name)
+    if redis.call('exists', 'user:' .. name) == 1 then
+        redis.call('zadd', 'user:' .. name .. ':conversation_list', now, conversation_id)
+    else
+        table.insert(missing, name)
+    end
+end
+if redis.call('hexists', conversation_key, 'status_count') == 1 then
+    redis.call('hincrby', conversation_key, 'status_count', 1)
+    redis.call('hincrby', conversation_key, 'conversation_count', joined)
+else
+    -- first post to a conversation created before the summary existed
+    redis.call('hmset', conversation_key,
+        'status_count', redis.call('zcard', conversation_key .. ':statuses'),
+        'conversation_count', redis.call('zcard', conversation_key .. ':access'))
+end
+redis.call('hset', conversation_key, 'latest_users',
+    cjson.encode(redis.call('zrevrange', conversation_key .. ':access', 0, 4)))
+redis.call('publish', conversation_key .. ':events', cjson.encode({
+    type = 'status', conversation_id = conversation_id, status_id = status_id,
+    user_name = user_name, status = status, status_html = status_html, created_time = now}))
+local updated = cjson.encode({
+    type = 'conversation', conversation_id = conversation_id, status_id = status_id,
+    user_name = user_name, updated_time = now})
+for _, name in ipairs(redis.call('zrange', conversation_key .. ':access', 0, -1)) do
+    if name ~= user_name and redis.call('exists', 'user:' .. name) == 1 then
+        redis.call('hincrby', 'user:' .. name .. ':unread', conversation_id, 1)
+    end
+    redis.call('publish', 'user:' .. name .. ':events', updated)
+end
+return {status_id, conversation_id, missing}
+"""
+post_status = app.redis.register_script(POST_STATUS_SCRIPT)
+
+at_re = re.compile(r'^@(?P<at>\S+)')
 
 
 @app.route('/statuses/update',methods=['POST'])
 @access_token
 def conversation_create():
-    conversation_id = request.form.get('conversation_id',None)
+    conversation_id = request.form.get('conversation_id','')
     status = request.form.get('status')
     #logging.error(status)
-    redirect_url = "/"
-    # database
-    status_id = app.redis.incr('count:status')
-    app.redis.hmset('status:%s'%(status_id), {'created_time':time.time(), 'status':status, 'user_name': g.user['name'] })
-    if conversation_id :
-        access =app.redis.zscore('conversation:%s:access'%conversation_id, g.user['name'])
-        logging.info(access)
-        if access :
-            redirect_url = "/show/%s"%(conversation_id)
-            app.redis.hmset( 'conversation:%s'%(conversation_id), {'updated_time':time.time(), 'status':status, 'user_name': g.user['name'] } )
-        else :
-            abort(403)
-    else :
-        conversation_id = app.redis.incr('count:conversation')
-        app.redis.hmset( 'conversation:%s'%( conversation_id), {'updated_time':time.time(), 'status':status, 'user_name': g.user['name'] } )
-        app.redis.zadd( 'conversation:%s:access'%conversation_id, g.user['name'], int(time.time()))
-    app.redis.zadd('user:%s:conversation_list'%g.user['name'], conversation_id, time.time())
-    app.redis.zadd('conversation:%s:statuses'%conversation_id, status_id, time.time())
-
-    at_re = re.compile(r'^@(?P<at>\S+)')
     at_names = [  at_re.match(k) for k in  status.split()  ]
     at_list = set(  k.group('at') for k in  at_names if k is not None  )
-    at_not_exists_users =  ( at for at in at_list if app.redis.exists( 'user:%s'%at) ==0    )
-    if at_not_exists_users :
-        print at_not_exists_users
-        weibo = app.redis.hgetall('weibo:%s'%g.user['weibo'] )
-        weibo_status = ' '.join( ['@'+k for k in at_not_exists_users]) + u'  元芳,你怎么看?'
-        if None and weibo :
-            app.client().post("statuses/update", access_token=weibo['access_token'], status=weibo_status )
-
-    for i in at_list :
-        app.redis.zadd('conversation:%s:access'%conversation_id, i, int(time.time()) )
-        user = app.redis.exists('user:%s'%i)
-        if user :
-            app.redis.zadd('user:%s:conversation_list'%i, conversation_id, time.time())
+    now = time.time()
+    # database
+    tokens = []
+    for token, tf in index_tokens(status).items() :
+        tokens += [token, tf]
+    status_html, timed_out = render_status(status)
+    result = post_status(args=[g.user['name'], status, now, int(now), conversation_id,
+                               status_html, html_key(status), len(at_list)]
+                               + list(at_list) + tokens)
+    if not result[0] :
+        abort(403)
+    status_id, conversation_id, at_not_exists_users = result
+    logging.info('status %s posted to conversation %s', status_id, conversation_id)
+    if timed_out :
+        render_later('status:%s'%status_id, html_key(status))
+        render_later('conversation:%s'%conversation_id, html_key(status))
+
+    if at_not_exists_users and app.config['WEIBO_MENTION_NOTIFY'] :
+        jobs.enqueue(app.redis, 'notify_mentions', weibo_id=g.user['weibo'],
+                     user_names=[ k.decode('utf-8') for k in at_not_exists_users ])
     return jsonwrite({'messages':'success'})
 
 
 
+# Ranks the statuses containing every token in ARGV[5..]: each status
+# scores the sum over tokens of occurrences * idf, idf being
+# 1 + ln(statuses / statuses containing the token). Going down the ranking
+# from offset ARGV[2], it keeps the statuses of conversations user ARGV[1]
+# has access to until it has ARGV[3] of them or has looked at ARGV[4]
+# candidates. The ranking lives in a temporary key for the duration of the
+# script only.
+# Returns {{status_id, score, ...}, offset to continue from or -1}.
+SEARCH_SCRIPT = """
+local user_name, offset, count, scan = ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local total = tonumber(redis.call('get', 'count:status') or 0)
+local ranking = 'search:ranking:' .. user_name
+local args = {ranking, #ARGV - 4}
+local weights = {'weights'}
+for i = 5, #ARGV do
+    local key = 'search:' .. ARGV[i]
+    local df = redis.call('zcard', key)
+    if df == 0 then
+        return {{}, -1}
+    end
+    table.insert(args, key)
+    table.insert(weights, tostring(1 + math.log((total + 1) / df)))
+end
+for _, weight in ipairs(weights) do
+    table.insert(args, weight)
+end
+local matches = redis.call('zinterstore', unpack(args))
+local hits = {}
+local pos = offset
+while #hits < count * 2 and pos < matches and pos < offset + scan do
+    local batch = redis.call('zrevrange', ranking, pos, pos + count - 1, 'withscores')
+    for j = 1, #batch, 2 do
+        pos = pos + 1
+        local conversation_id = redis.call('hget', 'status:' .. batch[j], 'conversation_id')
+        if conversation_id and redis.call('zscore', 'conversation:' .. conversation_id .. ':access', user_name) then
+            table.insert(hits, batch[j])
+            table.insert(hits, batch[j + 1])
+            if #hits == count * 2 then
+                break
+            end
+        end
+    end
+end
+redis.call('del', ranking)
+if pos >= matches then
+    pos = -1
+end
+return {hits, pos}
+"""
+search_script = app.redis.register_script(SEARCH_SCRIPT)
+
+
+@app.route('/search',methods=['GET'])
+@access_token
+def search():
+    """
+    Statuses the user can see containing every word of `q`, best match
+    first, `count` at a time. Pass the returned `next_cursor` as `cursor`
+    for the next page; it is null after the last one.
+    """
+    try:
+        count = min(int(request.args.get('count', 20)), 100)
+        cursor = int(request.args.get('cursor', 0))
+    except ValueError :
+        abort(400)
+    tokens = query_tokens(request.args.get('q', ''))
+    if not tokens or count < 1 or cursor < 0 :
+        return jsonwrite({'statuses': [], 'next_cursor': None})
+    hits, next_cursor = search_script(args=[g.user['name'], cursor, count, app.config['SEARCH_SCAN_LIMIT']]
+                                      + [ t.encode('utf-8') for t in tokens ])
+    scores = dict(zip(hits[0::2], hits[1::2]))
+    statuses = _load_statuses(hits[0::2])
+    for s in statuses :
+        s['score'] = float(scores[s['status_id']])
+    return jsonwrite({'statuses': statuses, 'next_cursor': next_cursor if next_cursor >= 0 else None})
+
+
+def _parse_cursor(cursor):
+    """Split a ``score:member`` cursor as produced by _zpage()."""
+    try:
+        score, member = cursor.split(':', 1)
+        return float(score), member.encode('utf-8')
+    except ValueError:
+        abort(400)
+
+
+def _zpage(key, count, before=None, after=None):
+    """Keyset pagination over the sorted set ``key``.
+
+    Members come back in ascending (score, member) order, which is the
+    order Redis keeps them in. ``after`` returns the members strictly
+    following a cursor, ``before`` those strictly preceding it, and with
+    neither the page starts at the beginning of the set. Cursors are
+    ``score:member`` strings, so they stay valid while members are added
+    or moved, unlike ranks.
+
+    Returns ``(members, next_cursor)``. ``next_cursor`` continues in the
+    same direction. An empty ``after`` page hands back the cursor it was
+    given so that clients can keep polling from it.
+    """
+    if before :
+        score, member = _parse_cursor(before)
+        fetch = lambda offset: app.redis.zrevrangebyscore(key, score, '-inf', start=offset, num=count, withscores=True)
+        wanted = lambda m, s: s < score or m < member
+    elif after :
+        score, member = _parse_cursor(after)
+        fetch = lambda offset: app.redis.zrangebyscore(key, score, '+inf', start=offset, num=count, withscores=True)
+        wanted = lambda m, s: s > score or m > member
+    else :
+        fetch = lambda offset: app.redis.zrangebyscore(key, '-inf', '+inf', start=offset, num=count, withscores=True)
+        wanted = lambda m, s: True
+    # Members sharing the cursor's score are filtered here rather than by
+    # an exclusive bound, so ties are neither skipped nor repeated.
+    page = []
+    offset = 0
+    while len(page) < count :
+        batch = fetch(offset)
+        page.extend( (m, s) for m, s in batch if wanted(m, s) )
+        if len(batch) < count :
+            break
+        offset += len(batch)
+    page = page[:count]
+    if before :
+        page.reverse()
+    if not page :
+        return [], after
+    last_member, last_score = page[0] if before else page[-1]
+    return [ m for m, s in page ], '%r:%s'%(last_score, last_member)
+
+
 @app.route('/conversation/list',methods=['GET'])
 @access_token
 def conversation_list():
-    since_id = int(request.args.get('since_id', 0) )
     count = int( request.args.get('count', 100) )
-    rank = 0
-    if since_id is not 0 :
-        rank = app.redis.zrank('user:%s:conversation_list'%g.user['name'], since_id)
-    conversation_list = app.redis.zrange( 'user:%s:conversation_list'%g.user['name'], rank, rank+count, False )
-    conv = []
-    for i in conversation_list :
-        c = app.redis.hgetall('conversation:%s'%i)
-        c['conversation_count'] = app.redis.zcard('conversation:%s:access'%i)
-        c['conversation_id'] = i
-        c['latest_users'] = app.redis.zrevrange('conversation:%s:access'%i,0,4,False)
-        c['status_count'] = app.redis.zcard('conversation:%s:statuses'%i)
-        c['user'] = app.redis.hgetall( 'user:%s'%c['user_name'])
-        c['updated_time'] = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(float(c['updated_time'])))
-        conv.append(c)
-    return jsonwrite(conv)
+    conversation_list, next_cursor = _zpage('user:%s:conversation_list'%g.user['name'], count,
+                                            before=request.args.get('before'), after=request.args.get('after'))
+    conv = _load_conversations(conversation_list)
+    return jsonwrite({'conversations': conv, 'next_cursor': next_cursor})
+
+
+@app.route('/unread',methods=['GET'])
+@access_token
+def unread():
+    conversations = dict( (i, int(n)) for i, n in app.redis.hgetall('user:%s:unread'%g.user['name']).items() )
+    return jsonwrite({'total': sum(conversations.values()), 'conversations': conversations})
 
 @app.route('/show/<int:conversation_id>')
 @access_token
 def conversation_show(conversation_id):
-    since_id = int(request.args.get('since_id', 0) )
     count = int( request.args.get('count', 100) )
-    rank = 0
-    if since_id is not 0 :
-        rank = app.redis.zrank('conversation:%s:statuses'%conversation_id)
-    c = app.redis.hgetall( 'conversation:%s'%conversation_id)
-    c['read_count'] = app.redis.zscore("user:%s:read_count"%g.user['name'],conversation_id)
-    c['conversation_count'] = app.redis.zcard('conversation:%s:access'%conversation_id)
+    pipe = app.redis.pipeline(transaction=False)
+    pipe.hgetall( 'conversation:%s'%conversation_id)
+    pipe.hget('user:%s:unread'%g.user['name'], conversation_id)
+    pipe.hdel('user:%s:unread'%g.user['name'], conversation_id)
+    c, unread, _ = pipe.execute()
+    c['conversation_id']=conversation_id
+    _decode_summaries([c])
+    _render_stale([c], ['conversation:%s'%conversation_id])
+    c['read_count'] = c['status_count'] - int(unread or 0)
     c['all_users'] = app.redis.zrevrange('conversation:%s:access'%conversation_id,0,-1,False)
-    c['status_count'] = app.redis.zcard('conversation:%s:statuses'%conversation_id)
-    app.redis.zadd("user:%s:read_count"%g.user['name'], conversation_id, c['status_count'])
     c['updated_time'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(float(c['updated_time'])))
-    c['statuses'] = [ (app.redis.hgetall('status:%s'%status_id))  for status_id in  app.redis.zrange('conversation:%s:statuses'%conversation_id, rank, rank+count, False) ]
-    c['conversation_id']=conversation_id
-    for s in c['statuses']:
-        s['user'] = app.redis.hgetall( 'user:%s'%s['user_name'])
-        s['created_time'] = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(float(s['created_time'])))
-    contacts = app.redis.zrange('user:%s:contact'%g.user['name'], 0, -1, False)
+    status_ids, c['next_cursor'] = _zpage('conversation:%s:statuses'%conversation_id, count,
+                                          before=request.args.get('before'), after=request.args.get('after'))
+    c['statuses'] = _load_statuses(status_ids)
     return jsonwrite(c)
 
+
+@app.route('/events',methods=['GET'])
+@access_token
+def events():
+    """Server-Sent Events stream of the user's 'conversation' events, plus
+    the 'status' events of ``conversation_id`` when one is given."""
+    channels = ['user:%s:events'%g.user['name']]
+    conversation_id = request.args.get('conversation_id')
+    if conversation_id :
+        if app.redis.zscore('conversation:%s:access'%conversation_id, g.user['name']) is None :
+            abort(403)
+        channels.append('conversation:%s:events'%conversation_id)
+    keepalive = app.config['EVENTS_KEEPALIVE']
+
+    def stream():
+        # Subscribed here rather than before the response: a generator
+        # closed before its first step never runs its finally clause.
+        queue = app.events.subscribe(channels)
+        try:
+            yield 'retry: 3000\n\n'
+            while True :
+                try:
+                    data = queue.get(timeout=keepalive)
+                except gevent.queue.Empty :
+                    yield ': keepalive\n\n'
+                    continue
+                yield 'event: %s\ndata: %s\n\n'%(json.loads(data)['type'], data)
+        finally:
+            app.events.unsubscribe(queue, channels)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 def jsonwrite(chunk):
     jsonp_callback = request.args.get('jsonp_callback', None)
     if request.method == 'GET' and isinstance(jsonp_callback, (str, unicode)):
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Background jobs kept off the request path, and the worker that runs them.
+
+Jobs are JSON documents on the ``queue:jobs`` list. A job queued with a
+dedupe key is dropped while an identical one is still waiting or running,
+so a user who logs in twice in a row gets a single contact sync.
+
+A worker moves each job it takes to a list of its own and removes it when
+the job is done. Workers keep a heartbeat key alive; the jobs of a worker
+whose heartbeat expired, e.g. because it was killed mid-job, go back on the
+queue.
+
+Run a worker with:
+
+    python jobs.py
+"""
+if __name__ == "__main__" :
+    import gevent.monkey
+    gevent.monkey.patch_all()
+
+import json
+import logging
+import os
+import socket
+import sys
+import time
+
+import redis
+import gevent
+from third.weibo2 import Client, ResponseCache
+from utils import pinyin
+from utils.markdown import Markdown
+from utils.search import index_tokens
+
+import settings
+
+log = logging.getLogger("jobs")
+
+QUEUE_KEY = 'queue:jobs'
+WORKERS_KEY = 'queue:workers'
+PROCESSING_KEY = 'queue:processing:%s'
+HEARTBEAT_KEY = 'queue:worker:%s'
+# seconds between heartbeats, and without one before a worker counts as dead
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_TTL = 30
+# seconds to wait after a Redis error, doubled up to the maximum while it
+# keeps failing
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 30
+
+# Queues the job in ARGV[1] unless the dedupe key in ARGV[2] is already
+# held. The key expires after ARGV[3] seconds so that a worker dying mid-job
+# cannot block that job forever.
+ENQUEUE_SCRIPT = """
+if ARGV[2] ~= '' then
+    if not redis.call('set', 'queue:pending:' .. ARGV[2], 1, 'NX', 'EX', ARGV[3]) then
+        return 0
+    end
+end
+redis.call('lpush', KEYS[1], ARGV[1])
+return 1
+"""
+
+# Stores the HTML in ARGV[2] as status_html of the status or conversation
+# hash KEYS[1] if its html_key is still ARGV[1].
+SET_STATUS_HTML_SCRIPT = """
+if redis.call('hget', KEYS[1], 'html_key') ~= ARGV[1] then
+    return 0
+end
+redis.call('hset', KEYS[1], 'status_html', ARGV[2])
+return 1
+"""
+
+redis_client = redis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=0)
+enqueue_script = redis_client.register_script(ENQUEUE_SCRIPT)
+set_status_html = redis_client.register_script(SET_STATUS_HTML_SCRIPT)
+
+# app.status_md with the longer time limit of the workers
+status_md = Markdown(safe_mode='escape', deterministic=True,
+                     max_length=settings.MARKDOWN_MAX_LENGTH,
+                     time_limit=settings.MARKDOWN_JOB_TIME_LIMIT)
+
+
+def enqueue(r, name, dedupe_key=None, **kwargs):
+    """Queue job ``name`` with keyword arguments ``kwargs``.
+
+    Returns False when a job with the same name and ``dedupe_key`` is
+    already pending.
+    """
+    if dedupe_key is not None :
+        dedupe_key = '%s:%s'%(name, dedupe_key)
+    job = json.dumps({'name': name, 'dedupe_key': dedupe_key, 'args': kwargs})
+    return bool(enqueue_script(keys=[QUEUE_KEY],
+                args=[job, dedupe_key or '', settings.JOB_DEDUPE_TTL], client=r))
+
+
+def get_client(r, access_token):
+    client = Client(settings.WEIBO_CONSUMER_KEY, settings.WEIBO_CONSUMER_SECRET, settings.REDIRECT_URI,
+                    cache=ResponseCache(r, ttls=settings.WEIBO_CACHE_TTLS))
+    client.set_token(access_token)
+    return client
+
+
+#---- contact index
+
+# Sorted set of 'key\0name' entries with score 0, where key is the
+# lowercased name or one of its pinyin spellings: a ZRANGEBYLEX on a
+# lowercased prefix finds every contact one of whose keys starts with it.
+CONTACT_INDEX = 'user:%s:contact:search'
+
+
+def index_contacts(pipe, user_name, names):
+    """Queue on ``pipe`` the index entries for ``names``."""
+    for name in names :
+        if isinstance(name, str) :
+            name = name.decode('utf-8')
+        for key in [name.lower()] + pinyin.search_keys(name) :
+            entry = u'%s\0%s'%(key, name)
+            pipe.zadd(CONTACT_INDEX%user_name, entry.encode('utf-8'), 0)
+
+
+#---- search backfill
+
+# set once index_statuses went through every conversation
+BACKFILL_KEY = 'backfill:search'
+# conversations an index_statuses job goes through before queueing the next
+BACKFILL_BATCH = 100
+
+
+def index_statuses(r, conversation_id=1):
+    """Add the statuses posted before /search existed to its index.
+
+    They also lack the conversation_id field SEARCH_SCRIPT checks access
+    with, which tells them apart: it is filled in from the
+    conversation:%s:statuses set they are in, together with their
+    search:<token> postings as POST_STATUS_SCRIPT writes them. Goes through
+    BACKFILL_BATCH conversations from ``conversation_id``, then queues
+    itself for the next ones.
+    """
+    last = int(r.get('count:conversation') or 0)
+    end = min(conversation_id + BACKFILL_BATCH, last + 1)
+    for i in range(conversation_id, end) :
+        status_ids = r.zrange('conversation:%s:statuses'%i, 0, -1)
+        pipe = r.pipeline(transaction=False)
+        for status_id in status_ids :
+            pipe.hmget('status:%s'%status_id, ['conversation_id', 'status'])
+        legacy = [ (status_id, status) for status_id, (cid, status) in zip(status_ids, pipe.execute())
+                   if cid is None and status is not None ]
+        if not legacy :
+            continue
+        pipe = r.pipeline()
+        for status_id, status in legacy :
+            for token, tf in index_tokens(status).items() :
+                pipe.zadd('search:%s'%token.encode('utf-8'), status_id, tf)
+            pipe.hset('status:%s'%status_id, 'conversation_id', i)
+        pipe.execute()
+    if end <= last :
+        enqueue(r, 'index_statuses', conversation_id=end)
+    else:
+        r.set(BACKFILL_KEY, 1)
+
+
+#---- jobs
+
+def sync_contacts(r, user_name, weibo_id):
+    """Copy the Weibo friends of ``weibo_id`` into ``user:%s:contact``.
+
+    The first page tells how many friends there are; the remaining pages
+    are then fetched concurrently. Nothing is written unless every page
+    came back, so that a failed sync is retried on the next login; each
+    page is then written with one pipelined round trip.
+    """
+    weibo = r.hgetall('weibo:%s'%weibo_id)
+    client = get_client(r, weibo['access_token'])
+    count = settings.WEIBO_FRIENDS_PAGE_SIZE
+    first = client.get("friendships/friends", uid=weibo_id, cursor=0, count=count)
+    pages = [first]
+    next_cursor = first.get('next_cursor', 0)
+    if next_cursor :
+        cursors = range(next_cursor, first.get('total_number', 0), count)
+        for result, error in client.get_many([ ("friendships/friends", {'uid': weibo_id, 'cursor': cursor, 'count': count})
+                                               for cursor in cursors ]) :
+            if error is not None :
+                raise error
+            pages.append(result)
+    for weibo_contact in pages :
+        pipe = r.pipeline(transaction=False)
+        users = weibo_contact.get('users', [])
+        for w in users :
+            pipe.zadd('user:%s:contact'%user_name, w['name'], time.time())
+            pipe.hmset('weibo:%s'%w['id'], w )
+        index_contacts(pipe, user_name, [ w['name'] for w in users ])
+        pipe.execute()
+
+
+def render_status(r, key, html_key, attempt=1):
+    """Render again the status on hash ``key``, stored as the plain text
+    fallback of a rendering that ran out of time, unless its ``html_key``
+    changed since. Gives up after MARKDOWN_JOB_ATTEMPTS tries."""
+    status = r.hget(key, 'status')
+    if status is None :
+        return
+    status_html, timed_out = status_md.convert_checked(status)
+    if not timed_out :
+        set_status_html(keys=[key], args=[html_key, status_html], client=r)
+    elif attempt < settings.MARKDOWN_JOB_ATTEMPTS :
+        enqueue(r, 'render_status', key=key, html_key=html_key, attempt=attempt+1)
+    else:
+        log.warning("giving up rendering %s", key)
+
+
+def notify_mentions(r, weibo_id, user_names):
+    """Post a Weibo status inviting mentioned people who have no account."""
+    weibo = r.hgetall('weibo:%s'%weibo_id)
+    if not weibo :
+        return
+    client = get_client(r, weibo['access_token'])
+    weibo_status = ' '.join( ['@'+k for k in user_names]) + u'  元芳,你怎么看?'
+    client.post("statuses/update", status=weibo_status)
+
+
+JOBS = {
+    'sync_contacts': sync_contacts,
+    'notify_mentions': notify_mentions,
+    'render_status': render_status,
+    'index_statuses': index_statuses,
+}
+
+
+#---- worker
+
+def worker_id():
+    return '%s:%d'%(socket.gethostname(), os.getpid())
+
+
+def work(r, worker=None):
+    """Run jobs from the queue forever."""
+    processing = PROCESSING_KEY%(worker or worker_id())
+    delay = RETRY_DELAY
+    while True :
+        try:
+            raw = r.brpoplpush(QUEUE_KEY, processing, 0)
+        except redis.RedisError :
+            log.exception("could not take a job, retrying in %ss", delay)
+            gevent.sleep(delay)
+            delay = min(delay*2, MAX_RETRY_DELAY)
+            continue
+        delay = RETRY_DELAY
+        run(r, processing, raw)
+
+
+def run(r, processing, raw):
+    """Run one job taken from the queue onto the list `processing`, then
+    remove it from there."""
+    dedupe_key = None
+    try:
+        job = json.loads(raw)
+        dedupe_key = job['dedupe_key']
+        JOBS[job['name']](r, **job['args'])
+    except Exception :
+        log.exception("job failed: %s", raw)
+    # Until it is removed the job counts as running: keep trying, rather
+    # than leave it to run again when this worker stops.
+    delay = RETRY_DELAY
+    while True :
+        try:
+            pipe = r.pipeline(transaction=False)
+            pipe.lrem(processing, raw, 1)
+            if dedupe_key :
+                pipe.delete('queue:pending:%s'%dedupe_key)
+            pipe.execute()
+            return
+        except redis.RedisError :
+            log.exception("could not finish a job, retrying in %ss", delay)
+            gevent.sleep(delay)
+            delay = min(delay*2, MAX_RETRY_DELAY)
+
+
+def requeue_orphans(r):
+    """Put the unfinished jobs of workers without a heartbeat back on the
+    queue."""
+    for worker in r.smembers(WORKERS_KEY) :
+        if r.exists(HEARTBEAT_KEY%worker) :
+            continue
+        while r.rpoplpush(PROCESSING_KEY%worker, QUEUE_KEY) is not None :
+            log.warning("requeued a job of dead worker %s", worker)
+        r.srem(WORKERS_KEY, worker)
+
+
+def heartbeat(r, worker):
+    while True :
+        try:
+            r.set(HEARTBEAT_KEY%worker, 1, ex=HEARTBEAT_TTL)
+            r.sadd(WORKERS_KEY, worker)
+            requeue_orphans(r)
+        except redis.RedisError :
+            log.exception("heartbeat failed")
+        gevent.sleep(HEARTBEAT_INTERVAL)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    r = redis_client
+    worker = worker_id()
+    if not r.exists(BACKFILL_KEY) :
+        enqueue(r, 'index_statuses', 'all')
+    greenlets = [ gevent.spawn(heartbeat, r, worker) ]
+    greenlets += [ gevent.spawn(work, r, worker) for i in range(settings.JOB_CONCURRENCY) ]
+    # none of them should ever end: if one does, exit so that the process
+    # is restarted, rather than keep a heartbeat for a worker that is gone
+    gevent.joinall(greenlets, count=1)
+    log.error("a worker greenlet ended, exiting")
+    sys.exit(1)
+
+
+if __name__ == "__main__" :
+    main()
@@ -8,4 +8,29 @@ REDIRECT_URI = 'http://ld.youpinapp.com:8888/auth/weibo/'
 LOGIN_URL = "/auth/login"
 REDIS_HOST = '127.0.0.1'
 REDIS_PORT = 6379
+# seconds Weibo API reads stay in the shared response cache, per endpoint
+WEIBO_CACHE_TTLS = {'users/show': 300, 'friendships/friends': 600}
 
+# /events streams: seconds between keepalive comments, and how many events
+# may queue up for a slow client before further ones are dropped
+EVENTS_KEEPALIVE = 15
+EVENTS_QUEUE_SIZE = 100
+
+# background jobs (see jobs.py): greenlets per worker process, and how long
+# a deduplicated job blocks an identical one if its worker dies
+JOB_CONCURRENCY = 4
+JOB_DEDUPE_TTL = 3600
+# friends fetched per friendships/friends call during contact sync (max 200)
+WEIBO_FRIENDS_PAGE_SIZE = 200
+# invite mentioned people without an account through a Weibo status
+WEIBO_MENTION_NOTIFY = False
+# matching statuses /search looks at per page before giving up on finding
+# enough the user has access to
+SEARCH_SCAN_LIMIT = 1000
+# markdown budget per status: longer ones, or ones still rendering after
+# this many seconds, are shown as escaped plain text; the ones that ran out
+# of time are rendered again by a job, with a longer limit and a few tries
+MARKDOWN_MAX_LENGTH = 10000
+MARKDOWN_TIME_LIMIT = 0.2
+MARKDOWN_JOB_TIME_LIMIT = 2
+MARKDOWN_JOB_ATTEMPTS = 3
@@ -9,43 +9,350 @@ than the official SDK.
 For more info, refer to:
 http://lxyu.github.com/weibo/
 """
-# patch gevent socket.getaddrinfo
+import json
+import time
+import random
+import hashlib
+import urllib
+import logging
+
+import socket
+import thread
+import  requests
+from requests.adapters import HTTPAdapter
 try:
-    import gevent.socket as socket
-    origGetAddrInfo = socket.getaddrinfo
-
-    def getAddrInfoWrapper(host, port, family=0, socktype=0, proto=0, flags=0):
-        return origGetAddrInfo(host, port, socket.AF_INET, socktype, proto, flags)
-        # replace the original socket.getaddrinfo by our version
-    socket.getaddrinfo = getAddrInfoWrapper
-except:
+    import gevent.socket
+    from gevent.pool import Pool
+    from gevent.event import AsyncResult
+except ImportError:
+    gevent = Pool = AsyncResult = None
+
+log = logging.getLogger("weibo")
+
+
+class CachingResolver(object):
+    """
+    IPv4-only `getaddrinfo` with a cache in front of it.
+
+    Answers are kept for `ttl` seconds and failures for `negative_ttl`
+    seconds. For a further `stale_ttl` seconds an expired answer, though
+    not an expired failure, is still returned at once while a background
+    lookup refreshes it, so a slow DNS server only delays the calls that
+    find nothing usable in the cache.
+    """
+    def __init__(self, ttl=300, negative_ttl=30, stale_ttl=3600, max_size=1024):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stale_ttl = stale_ttl
+        self.max_size = max_size
+        # (host, port, socktype, proto, flags) -> (expires, addrinfo or gaierror)
+        self.cache = {}
+        self.refreshing = set()
+        self.stats = {'hits': 0, 'misses': 0, 'stale': 0, 'negative': 0}
+
+    def install(self, module):
+        """Replace `module.getaddrinfo` by a cached, IPv4-only version."""
+        resolve = module.getaddrinfo
+
+        def getaddrinfo(host, port, family=0, socktype=0, proto=0, flags=0):
+            return self.getaddrinfo(resolve, host, port, socktype, proto, flags)
+        module.getaddrinfo = getaddrinfo
+
+    def getaddrinfo(self, resolve, host, port, socktype=0, proto=0, flags=0):
+        key = (host, port, socktype, proto, flags)
+        entry = self.cache.get(key)
+        now = time.time()
+        if (entry is None or now >= entry[0] + self.stale_ttl
+                or now >= entry[0] and isinstance(entry[1], socket.gaierror)):
+            # failures are never served stale
+            self.stats['misses'] += 1
+            entry = self._resolve(resolve, key)
+            self._store(key, entry)
+        elif now >= entry[0]:
+            self.stats['stale'] += 1
+            if key not in self.refreshing:
+                # a greenlet once gevent has patched the thread module
+                self.refreshing.add(key)
+                thread.start_new_thread(self._refresh, (resolve, key))
+        else:
+            self.stats['hits'] += 1
+        if isinstance(entry[1], socket.gaierror):
+            self.stats['negative'] += 1
+            raise entry[1]
+        return entry[1]
+
+    def _resolve(self, resolve, key):
+        host, port, socktype, proto, flags = key
+        try:
+            return (time.time() + self.ttl,
+                    resolve(host, port, socket.AF_INET, socktype, proto, flags))
+        except socket.gaierror, e:
+            return (time.time() + self.negative_ttl, e)
+
+    def _store(self, key, entry):
+        if len(self.cache) >= self.max_size:
+            now = time.time()
+            for k, v in self.cache.items():
+                if now >= v[0] + self.stale_ttl:
+                    self.cache.pop(k, None)
+            if len(self.cache) >= self.max_size:
+                self.cache.clear()
+        self.cache[key] = entry
+
+    def _refresh(self, resolve, key):
+        try:
+            entry = self._resolve(resolve, key)
+            if isinstance(entry[1], socket.gaierror):
+                # keep serving the stale answer until it runs out
+                log.warning("DNS refresh of %s failed: %s", key[0], entry[1])
+            else:
+                self._store(key, entry)
+        except Exception:
+            log.exception("DNS refresh of %s failed", key[0])
+        finally:
+            self.refreshing.discard(key)
+
+
+resolver = CachingResolver()
+if gevent is not None:
+    resolver.install(gevent.socket)
+resolver.install(socket)
+
+# Weibo error codes meaning "slow down": IP, user and per-API rate limits.
+RATE_LIMIT_ERRORS = (10022, 10023, 10024)
+
+
+class APIError(RuntimeError):
+    def __init__(self, error_code, error):
+        RuntimeError.__init__(self, "%s: %s" % (error_code, error))
+        self.error_code = error_code
+        self.error = error
+
+
+class CircuitOpenError(RuntimeError):
     pass
 
-# patch socket.getaddrinfo
 
-import socket
-origGetAddrInfo = socket.getaddrinfo
+class TokenBucket(object):
+    """Allow `rate` calls per second on average, in bursts of `capacity`."""
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.updated = time.time()
 
-def getAddrInfoWrapper(host, port, family=0, socktype=0, proto=0, flags=0):
-    return origGetAddrInfo(host, port, socket.AF_INET, socktype, proto, flags)
-# replace the original socket.getaddrinfo by our version
-socket.getaddrinfo = getAddrInfoWrapper
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
 
-import json
-import sys
-import time
-import urllib
-import logging
+    @property
+    def idle(self):
+        self._refill()
+        return self.tokens >= self.capacity
 
-import  requests
+    def acquire(self):
+        """
+        Take a token, sleeping until one is available.
+        """
+        self._refill()
+        while self.tokens < 1:
+            time.sleep((1 - self.tokens) / self.rate)
+            self._refill()
+        self.tokens -= 1
+
+
+class CircuitBreaker(object):
+    """Fail fast once Weibo looks down.
+
+    After `threshold` consecutive failures calls are refused for
+    `reset_timeout` seconds. The circuit is then half-open: the first call
+    is let through as a trial and the others are still refused, until the
+    trial closes the circuit by succeeding or reopens it by failing. A
+    trial that never reports back is replaced by another one after
+    `reset_timeout` seconds.
+    """
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        now = time.time()
+        if now - self.opened_at >= self.reset_timeout:
+            # half-open: this call is the trial, the ones until it reports
+            # back are refused as if the circuit had just opened
+            self.opened_at = now
+            return True
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_at = time.time()
+
+
+class Transport(object):
+    """
+    HTTP transport shared by all clients: a bounded connection pool,
+    connect/read timeouts, retries with jittered exponential backoff, token
+    buckets per app key and per user token, and a circuit breaker.
+
+    Only GETs are retried after a request may have reached Weibo; a POST
+    is retried when the connection could not be made or when Weibo
+    rejected it for rate limiting, so a status is never posted twice.
+    """
+    def __init__(self, pool_size=20, connect_timeout=3.05, read_timeout=10,
+                 retries=3, backoff=0.5, max_backoff=8,
+                 app_rate=10, app_burst=20, token_rate=1, token_burst=5,
+                 breaker_threshold=5, breaker_reset=30, verify=True):
+        self.session = requests.Session()
+        self.session.verify = verify
+        # pool_block: wait for a free connection instead of opening more
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.app_limit = (app_rate, app_burst)
+        self.token_limit = (token_rate, token_burst)
+        self.buckets = {}
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset)
+
+    def _bucket(self, key, limit):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) > 10000:
+                # forget the users that have been quiet long enough to refill
+                for k, b in self.buckets.items():
+                    if b.idle:
+                        del self.buckets[k]
+            bucket = self.buckets[key] = TokenBucket(*limit)
+        return bucket
+
+    def _throttle(self, client_id, access_token):
+        self._bucket(('app', client_id), self.app_limit).acquire()
+        if access_token:
+            self._bucket(('token', access_token), self.token_limit).acquire()
+
+    def _sleep(self, attempt):
+        delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+        time.sleep(random.uniform(0, delay))
+
+    def request(self, method, url, client_id, access_token=None, **kwargs):
+        """
+        Send a request and return the decoded JSON body.
+        """
+        idempotent = method == 'GET'
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            if not self.breaker.allow():
+                raise CircuitOpenError("weibo circuit open, refusing %s %s" % (method, url))
+            self._throttle(client_id, access_token)
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except requests.exceptions.ConnectTimeout:
+                # never reached Weibo, so safe to retry whatever the method
+                self.breaker.failure()
+                if last:
+                    raise
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                self.breaker.failure()
+                if last or not idempotent:
+                    raise
+            else:
+                if response.status_code >= 500:
+                    self.breaker.failure()
+                    if last or not idempotent:
+                        response.raise_for_status()
+                else:
+                    self.breaker.success()
+                    result = response.json()
+                    if last or result.get('error_code') not in RATE_LIMIT_ERRORS:
+                        return result
+            log.debug("retrying %s %s (attempt %d)", method, url, attempt + 1)
+            self._sleep(attempt)
+
+
+class ResponseCache(object):
+    """
+    Shared TTL cache for API reads, stored in Redis so that every worker
+    sees the same entries.
+
+    Entries are keyed by endpoint, parameters and token scope: endpoints in
+    `shared` answer the same for every user and share one entry per
+    parameter set, the others are cached per access token. Only endpoints
+    with a TTL in `ttls` are cached. Concurrent misses for the same entry
+    in one process wait for a single API call.
+    """
+    ttls = {'users/show': 300, 'friendships/friends': 600}
+    shared = frozenset(['users/show'])
+    # key -> AsyncResult of the call in progress, shared by all instances
+    inflight = {}
+
+    def __init__(self, redis, ttls=None, shared=None, prefix='weibo:cache:'):
+        self.redis = redis
+        if ttls is not None:
+            self.ttls = ttls
+        if shared is not None:
+            self.shared = frozenset(shared)
+        self.prefix = prefix
+
+    def key(self, uri, params, access_token):
+        if uri in self.shared:
+            scope = 'app'
+        else:
+            scope = hashlib.sha1(access_token or '').hexdigest()
+        params = sorted((k, v) for k, v in params.items() if k != 'access_token')
+        return self.prefix + hashlib.sha1(json.dumps([uri, scope, params])).hexdigest()
+
+    def get(self, uri, params, access_token, fetch):
+        """
+        Return the cached response for this call, or `fetch()` it and cache
+        the result. Errors are not cached.
+        """
+        ttl = self.ttls.get(uri)
+        if not ttl:
+            return fetch()
+        key = self.key(uri, params, access_token)
+        cached = self.redis.get(key)
+        if cached is not None:
+            return json.loads(cached)
+        if AsyncResult is None:
+            result = fetch()
+            self.redis.set(key, json.dumps(result), ex=ttl)
+            return result
+        pending = self.inflight.get(key)
+        if pending is not None:
+            return pending.get()
+        pending = self.inflight[key] = AsyncResult()
+        try:
+            result = fetch()
+            self.redis.set(key, json.dumps(result), ex=ttl)
+        except Exception, e:
+            pending.set_exception(e)
+            raise
+        else:
+            pending.set(result)
+            return result
+        finally:
+            del self.inflight[key]
 
 
 class Client(object):
-    session = requests.session()
-    session.verify = False
-    session.config['verify']  = False
-    session.config['timeout'] = 600
-    def __init__(self, api_key, api_secret, redirect_uri):
+    transport = Transport()
+    cache = None
+
+    def __init__(self, api_key, api_secret, redirect_uri, transport=None, cache=None):
         # const define
         self.site = 'https://api.weibo.com/'
         self.authorization_url = self.site + 'oauth2/authorize'
@@ -56,6 +363,10 @@ class Client(object):
         self.client_id = api_key
         self.client_secret = api_secret
         self.redirect_uri = redirect_uri
+        if transport is not None:
+            self.transport = transport
+        if cache is not None:
+            self.cache = cache
 
         self.access_token = None
         self.expires_in = None
@@ -70,9 +381,7 @@ class Client(object):
             'redirect_uri': self.redirect_uri
         }
 
-        response = Client.session.post(self.token_url, data=params, verify=False, config={'verbose':sys.stderr})
-        return response.json
-
+        return self.transport.request('POST', self.token_url, self.client_id, data=params)
 
     @property
     def authorize_url(self):
@@ -118,7 +427,7 @@ class Client(object):
 
     def _assert_error(self, d):
         if 'error_code' in d and 'error' in d:
-            raise RuntimeError("%s: %s" % (d['error_code'], d['error']))
+            raise APIError(d['error_code'], d['error'])
         return
 
     def get(self, uri, **kwargs):
@@ -128,9 +437,37 @@ class Client(object):
         url = "%s%s.json" % (self.api_url, uri)
         params = kwargs
         params['access_token'] = self.access_token
-        result = Client.session.get(url,  params=params,  verify=False, config={'verbose':sys.stderr}).json
-        self._assert_error(result)
-        return result
+
+        def fetch():
+            result = self.transport.request('GET', url, self.client_id, self.access_token, params=params)
+            self._assert_error(result)
+            return result
+
+        if self.cache is None:
+            return fetch()
+        return self.cache.get(uri, params, self.access_token, fetch)
+
+    def get_many(self, calls, size=10):
+        """
+        Run independent GET calls concurrently on a pool of `size`
+        greenlets.
+
+        `calls` is a sequence of (uri, params) pairs. Returns one
+        (result, error) pair per call, in the order of `calls`; a failed
+        call has its exception as error and None as result. Without gevent
+        the calls run one after another.
+        """
+        def call(uri_params):
+            uri, params = uri_params
+            try:
+                return self.get(uri, **dict(params)), None
+            except Exception, e:
+                log.warning("GET %s %r failed: %s", uri, params, e)
+                return None, e
+
+        if Pool is None:
+            return map(call, calls)
+        return Pool(size).map(call, calls)
 
 
     def post(self, uri, **kwargs):
@@ -139,6 +476,6 @@ class Client(object):
         """
         url = "%s%s.json" % (self.api_url, uri)
         params = {'access_token':self.access_token}
-        result =  Client.session.post(url, data=kwargs, params= params, verify=False, config={'verbose':sys.stderr}).json
+        result = self.transport.request('POST', url, self.client_id, self.access_token, data=kwargs, params=params)
         self._assert_error(result)
-        return result
\ No newline at end of file
+        return result
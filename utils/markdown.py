@@ -50,16 +50,20 @@ __author__ = "Trent Mick"
 
 import os
 import sys
-from pprint import pprint
+import copy
 import re
+import bisect
 import logging
 try:
-    from hashlib import md5
+    from hashlib import md5, sha1
 except ImportError:
     from md5 import md5
-import optparse
-from random import random
+    from sha import sha as sha1
+from random import random, Random
 import codecs
+import time
+import threading
+from collections import OrderedDict
 
 
 
@@ -84,15 +88,52 @@ log = logging.getLogger("markdown")
 
 DEFAULT_TAB_WIDTH = 4
 
-# Table of hash values for escaped characters:
-def _escape_hash(s):
-    # Lame attempt to avoid possible collision with someone actually
-    # using the MD5 hexdigest of one of these chars in there text.
-    # Other ideas: random.random(), uuid.uuid()
-    #return md5(s).hexdigest()   # Markdown.pl effectively does this.
-    return 'md5-'+md5(s).hexdigest()
-g_escape_table = dict([(ch, _escape_hash(ch))
+# Placeholders are made of private-use code points, which no Markdown
+# syntax matches. Text that already contains code points from the range used
+# here has them swapped for tokens on the way in and back on the way out
+# (see Markdown._convert()), so placeholders never collide with user text.
+#
+# An escaped character is a single code point, U+E000 plus its ASCII code:
+g_escape_table = dict([(ch, unichr(0xE000 + ord(ch)))
                        for ch in '\\`*_{}[]()>#+-.!'])
+g_unescape_table = dict([(ord(token), unicode(ch))
+                         for ch, token in g_escape_table.items()])
+
+# Hashed HTML blocks and spans, and link pattern links, become per-document
+# tokens: _TOKEN_START, a counter in _TOKEN_DIGITS, _TOKEN_END. Protected
+# user characters start with _TOKEN_USER instead.
+_TOKEN_START = u'\ue100'
+_TOKEN_USER = u'\ue101'
+_TOKEN_END = u'\ue102'
+_TOKEN_DIGITS = u''.join(unichr(0xE110 + i) for i in range(16))
+_token_re = re.compile(u'([%s%s][%s]+%s)' % (_TOKEN_START, _TOKEN_USER,
+                                            _TOKEN_DIGITS, _TOKEN_END))
+_trailing_token_re = re.compile(u'[%s%s][%s]+%s$' % (_TOKEN_START, _TOKEN_USER,
+                                                     _TOKEN_DIGITS, _TOKEN_END))
+_reserved_re = re.compile(u'[\ue000-\ue1ff]')
+_escaped_char_re = re.compile(u'[%s]' % u''.join(g_escape_table.values()))
+
+# Placeholders used to be 'md5-' and 'md5:' plus an MD5 hex digest, and a
+# few regexes below still treat them like that so that output does not
+# change: tokens count as word characters and as starting with a letter,
+# and an escaped character as ending with a letter when its digest did.
+_escape_chars = u''.join(g_escape_table.values())
+_escape_chars_ending_in_letter = u''.join(
+    [token for ch, token in g_escape_table.items()
+     if md5(ch).hexdigest()[-1] in 'abcdef'])
+
+
+class _lazy_re(object):
+    """A regex class attribute that is compiled the first time it is used,
+    so that importing the module does not compile them all."""
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+        self.regex = None
+    def __get__(self, obj, cls):
+        if self.regex is None:
+            self.regex = re.compile(self.pattern, self.flags)
+        return self.regex
 
 
 
@@ -101,6 +142,13 @@ g_escape_table = dict([(ch, _escape_hash(ch))
 class MarkdownError(Exception):
     pass
 
+class _OverBudget(Exception):
+    # Gives up on the conversion in progress; the text is converted as
+    # plain text instead.
+    def __init__(self, reason, timed_out=False):
+        Exception.__init__(self, reason)
+        self.timed_out = timed_out
+
 
 
 #---- public api
@@ -108,20 +156,47 @@ class MarkdownError(Exception):
 def markdown_path(path, encoding="utf-8",
                   html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
                   safe_mode=None, extras=None, link_patterns=None,
-                  use_file_vars=False):
+                  use_file_vars=False, deterministic=False,
+                  max_length=None, time_limit=None):
     text = codecs.open(path, 'r', encoding).read()
     return Markdown(html4tags=html4tags, tab_width=tab_width,
                     safe_mode=safe_mode, extras=extras,
                     link_patterns=link_patterns,
-                    use_file_vars=use_file_vars).convert(text)
+                    use_file_vars=use_file_vars,
+                    deterministic=deterministic,
+                    max_length=max_length,
+                    time_limit=time_limit).convert(text)
 
 def markdown(text, html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
              safe_mode=None, extras=None, link_patterns=None,
-             use_file_vars=False):
+             use_file_vars=False, deterministic=False,
+             max_length=None, time_limit=None):
+    return Markdown(html4tags=html4tags, tab_width=tab_width,
+                    safe_mode=safe_mode, extras=extras,
+                    link_patterns=link_patterns,
+                    use_file_vars=use_file_vars,
+                    deterministic=deterministic,
+                    max_length=max_length,
+                    time_limit=time_limit).convert(text)
+
+def markdown_many(texts, html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
+                  safe_mode=None, extras=None, link_patterns=None,
+                  use_file_vars=False, deterministic=False,
+                  max_length=None, time_limit=None, pool=None, chunksize=64):
+    """Convert each of `texts` with one converter; see Markdown.convert_many."""
     return Markdown(html4tags=html4tags, tab_width=tab_width,
                     safe_mode=safe_mode, extras=extras,
                     link_patterns=link_patterns,
-                    use_file_vars=use_file_vars).convert(text)
+                    use_file_vars=use_file_vars,
+                    deterministic=deterministic,
+                    max_length=max_length,
+                    time_limit=time_limit).convert_many(
+                        texts, pool=pool, chunksize=chunksize)
+
+def _convert_chunk(args):
+    # Runs in a pool worker: the converter comes pickled along with its texts.
+    markdowner, texts = args
+    return [markdowner.convert_checked(text) for text in texts]
 
 class Markdown(object):
     # The dict of "extras" to enable in processing -- a mapping of
@@ -141,11 +216,26 @@ class Markdown(object):
     # Used to track when we're inside an ordered or unordered list
     # (see _ProcessListItems() for details):
     list_level = 0
+    # ... and inside a blockquote. Lists and blockquotes nested deeper than
+    # max_nesting are left as text: each level recurses into the block
+    # gamut, and the HTML grows with the square of the depth.
+    quote_level = 0
+    max_nesting = 16
+
+    # When the conversion in progress runs out of time (see time_limit).
+    _deadline = None
 
-    _ws_only_line_re = re.compile(r"^[ \t]+$", re.M)
+    _ws_only_line_re = _lazy_re(r"^[ \t]+$", re.M)
+
+    # Anything that could make the full pipeline do more than wrap the text
+    # in paragraphs: inline syntax and escapes anywhere, block syntax and
+    # indentation at the start of a line, and carriage returns, tabs and
+    # placeholder code points. Most statuses match none of it.
+    _markup_re = _lazy_re(u'[\\\\`*_\\[<>&\r\t\ue000-\ue1ff]|^(?:[ #+=-]|\\d+\\.)', re.M)
 
     def __init__(self, html4tags=False, tab_width=4, safe_mode=None,
-                 extras=None, link_patterns=None, use_file_vars=False):
+                 extras=None, link_patterns=None, use_file_vars=False,
+                 deterministic=False, max_length=None, time_limit=None):
         if html4tags:
             self.empty_element_suffix = ">"
         else:
@@ -172,7 +262,16 @@ class Markdown(object):
         self._instance_extras = self.extras.copy()
         self.link_patterns = link_patterns
         self.use_file_vars = use_file_vars
-        self._outdent_re = re.compile(r'^(\t|[ ]{1,%d})' % tab_width, re.M)
+        # Same input, same output: email obfuscation is seeded from the
+        # address instead of random(), so the HTML can be cached.
+        self.deterministic = deterministic
+        # Budget for one convert(): texts of more than `max_length`
+        # characters, and texts still being converted after `time_limit`
+        # seconds, come out as escaped plain text instead. The time is
+        # checked between blocks, paragraphs, list items and links.
+        self.max_length = max_length
+        self.time_limit = time_limit
+        self._outdent_re = _outdent_re_from_tab_width(tab_width)
 
     def reset(self):
         self.urls = {}
@@ -180,13 +279,113 @@ class Markdown(object):
         self.html_blocks = {}
         self.html_spans = {}
         self.list_level = 0
+        self.quote_level = 0
+        self.reserved = {}
+        self._token_count = 0
         self.extras = self._instance_extras.copy()
         if "footnotes" in self.extras:
             self.footnotes = {}
             self.footnote_ids = []
 
+    def _token(self, value, table, start=_TOKEN_START):
+        """Return a new placeholder for `value`, recorded in `table`."""
+        self._token_count += 1
+        key = start + u''.join([_TOKEN_DIGITS[int(d, 16)]
+                                for d in '%x' % self._token_count]) + _TOKEN_END
+        table[key] = value
+        return key
+
     def convert(self, text):
-        """Convert the given text."""
+        """Convert the given text.
+
+        The per-document state (link definitions, hashed HTML blocks, list
+        nesting...) lives on a shallow copy of this converter made for the
+        call, so one configured instance can convert any number of texts,
+        also concurrently from several greenlets or threads.
+        """
+        return self.convert_checked(text)[0]
+
+    def convert_checked(self, text):
+        """Convert the given text; return the HTML and whether the time
+        limit ran out. The HTML is then the plain text fallback, which is
+        worth converting again later rather than keeping for good: with
+        less load on the machine it may well fit in time.
+        """
+        markdowner = copy.copy(self)
+        if self.time_limit is not None:
+            markdowner._deadline = time.time() + self.time_limit
+        try:
+            return markdowner._convert(text), False
+        except _OverBudget, ex:
+            return self._convert_plain(text, str(ex)), ex.timed_out
+        except RuntimeError:
+            # maximum recursion depth exceeded
+            return self._convert_plain(text, "nested too deeply"), False
+
+    def _convert_plain(self, text, reason):
+        # Fallback for texts over budget: paragraphs and line breaks only.
+        log.warning("converting %d characters as plain text: %s",
+                    len(text), reason)
+        if not isinstance(text, unicode):
+            text = unicode(text, 'utf-8')
+        text = re.sub("\r\n|\r", "\n", text)
+        text = self._ws_only_line_re.sub("", text)
+        for before, after in [('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;')]:
+            text = text.replace(before, after)
+        return self._form_plain_paragraphs(text) + "\n"
+
+    def _check_time_limit(self):
+        if self._deadline is not None and time.time() > self._deadline:
+            raise _OverBudget("took over %ss" % self.time_limit, True)
+
+    # Some of every syntax, for warm_up().
+    _warm_up_text = (u"Title\n=====\n\n## Sub ##\n\n* * *\n\n"
+                     u"- a *em* __strong__ `code`\n    1. b\n\n"
+                     u"    indented code\n\n> quote [link](http://x.com \"t\")\n\n"
+                     u"[ref][1] ![img][1] <http://x.com> <a@x.com> <b>x</b> & <\n\n"
+                     u"<div>\nblock\n</div>\n\n[1]: http://x.com\n[^1]: note\n\n"
+                     u">>> shell\n\n<?xml x?>\n\n\r\n")
+
+    def warm_up(self):
+        """Compile every regex this converter can use and convert a sample
+        text, so that the first real conversion does not pay for it. Call it
+        e.g. when a server process starts, before it forks or takes
+        requests."""
+        for cls in type(self).__mro__:
+            for attr in cls.__dict__.values():
+                if isinstance(attr, _lazy_re):
+                    attr.__get__(self, cls)
+        self.convert(self._warm_up_text)
+
+    def convert_many(self, texts, pool=None, chunksize=64, checked=False):
+        """Convert a batch of texts, returning the HTML in the same order,
+        or with `checked` the (html, timed out) pairs of convert_checked().
+
+        Equal texts are converted only once. If `pool` (a
+        multiprocessing.Pool) is given and there are more than `chunksize`
+        distinct texts, they are converted by its workers `chunksize` at a
+        time; this converter must then be picklable, e.g. its link patterns
+        cannot use lambdas.
+        """
+        index = {}
+        unique = []
+        for text in texts:
+            if text not in index:
+                index[text] = len(unique)
+                unique.append(text)
+        if pool is not None and len(unique) > chunksize:
+            chunks = [(self, unique[i:i+chunksize])
+                      for i in range(0, len(unique), chunksize)]
+            html = []
+            for part in pool.map(_convert_chunk, chunks):
+                html.extend(part)
+        else:
+            html = _convert_chunk((self, unique))
+        if not checked:
+            html = [converted for converted, timed_out in html]
+        return [html[index[text]] for text in texts]
+
+    def _convert(self, text):
         # Main function. The order in which other subs are called here is
         # essential. Link and image substitutions need to happen before
         # _EscapeSpecialChars(), so that any *'s or _'s in the <a>
@@ -201,13 +400,14 @@ class Markdown(object):
         if not isinstance(text, unicode):
             #TODO: perhaps shouldn't presume UTF-8 for string input?
             text = unicode(text, 'utf-8')
+        if self.max_length is not None and len(text) > self.max_length:
+            raise _OverBudget("longer than %d characters" % self.max_length)
 
         if self.use_file_vars:
             # Look for emacs-style file variable hints.
             emacs_vars = self._get_emacs_vars(text)
             if "markdown-extras" in emacs_vars:
-                splitter = re.compile("[ ,]+")
-                for e in splitter.split(emacs_vars["markdown-extras"]):
+                for e in self._extras_splitter_re.split(emacs_vars["markdown-extras"]):
                     if '=' in e:
                         ename, earg = e.split('=', 1)
                         try:
@@ -218,8 +418,13 @@ class Markdown(object):
                         ename, earg = e, None
                     self.extras[ename] = earg
 
+        # Plain text only needs paragraphs and line breaks.
+        if not self.extras and not self._markup_re.search(text):
+            return self._form_plain_paragraphs(text) + "\n"
+
         # Standardize line endings:
-        text = re.sub("\r\n|\r", "\n", text)
+        if "\r" in text:
+            text = re.sub("\r\n|\r", "\n", text)
 
         # Make sure $text ends with a couple of newlines:
         text += "\n\n"
@@ -227,6 +432,11 @@ class Markdown(object):
         # Convert all tabs to spaces.
         text = self._detab(text)
 
+        # Set aside characters that could be mistaken for placeholders.
+        # (After detabbing, which counts them as one column each.)
+        text = _reserved_re.sub(
+            lambda m: self._token(m.group(0), self.reserved, _TOKEN_USER), text)
+
         # Strip any lines consisting only of spaces and tabs.
         # This makes subsequent regexen easier to write, because we can
         # match consecutive blank lines with /\n+/ instead of something
@@ -257,10 +467,14 @@ class Markdown(object):
         if self.safe_mode:
             text = self._unhash_html_spans(text)
 
+        if self.reserved:
+            text = _unhash(text, self.reserved)
+
         text += "\n"
         return text
 
-    _emacs_oneliner_vars_pat = re.compile(r"-\*-\s*([^\r\n]*?)\s*-\*-", re.UNICODE)
+    _extras_splitter_re = _lazy_re("[ ,]+")
+    _emacs_oneliner_vars_pat = _lazy_re(r"-\*-\s*([^\r\n]*?)\s*-\*-", re.UNICODE)
     # This regular expression is intended to match blocks like this:
     #    PREFIX Local Variables: SUFFIX
     #    PREFIX mode: Tcl SUFFIX
@@ -269,7 +483,7 @@ class Markdown(object):
     # - "[ \t]" is used instead of "\s" to specifically exclude newlines
     # - "(\r\n|\n|\r)" is used instead of "$" because the sre engine does
     #   not like anything other than Unix-style line terminators.
-    _emacs_local_vars_pat = re.compile(r"""^
+    _emacs_local_vars_pat = _lazy_re(r"""^
         (?P<prefix>(?:[^\r\n|\n|\r])*?)
         [\ \t]*Local\ Variables:[\ \t]*
         (?P<suffix>.*?)(?:\r\n|\n|\r)
@@ -379,7 +593,7 @@ class Markdown(object):
 
     # Cribbed from a post by Bart Lateur:
     # <http://www.nntp.perl.org/group/perl.macperl.anyperl/154>
-    _detab_re = re.compile(r'(.*?)\t', re.M)
+    _detab_re = _lazy_re(r'(.*?)\t', re.M)
     def _detab_sub(self, match):
         g1 = match.group(1)
         return g1 + (' ' * (self.tab_width - len(g1) % self.tab_width))
@@ -403,7 +617,7 @@ class Markdown(object):
         return self._detab_re.subn(self._detab_sub, text)[0]
 
     _block_tags_a = 'p|div|h[1-6]|blockquote|pre|table|dl|ol|ul|script|noscript|form|fieldset|iframe|math|ins|del'
-    _strict_tag_block_re = re.compile(r"""
+    _strict_tag_block_re = _lazy_re(r"""
         (                       # save in \1
             ^                   # start of line  (with re.M)
             <(%s)               # start tag = \2
@@ -417,7 +631,7 @@ class Markdown(object):
         re.X | re.M)
 
     _block_tags_b = 'p|div|h[1-6]|blockquote|pre|table|dl|ol|ul|script|noscript|form|fieldset|iframe|math'
-    _liberal_tag_block_re = re.compile(r"""
+    _liberal_tag_block_re = _lazy_re(r"""
         (                       # save in \1
             ^                   # start of line  (with re.M)
             <(%s)               # start tag = \2
@@ -434,8 +648,7 @@ class Markdown(object):
         html = match.group(1)
         if raw and self.safe_mode:
             html = self._sanitize_html(html)
-        key = _hash_text(html)
-        self.html_blocks[key] = html
+        key = self._token(html, self.html_blocks)
         return "\n\n" + key + "\n\n"
 
     def _hash_html_blocks(self, text, raw=False):
@@ -529,8 +742,7 @@ class Markdown(object):
                 html = text[start_idx:end_idx]
                 if raw and self.safe_mode:
                     html = self._sanitize_html(html)
-                key = _hash_text(html)
-                self.html_blocks[key] = html
+                key = self._token(html, self.html_blocks)
                 text = text[:start_idx] + "\n\n" + key + "\n\n" + text[end_idx:]
 
         if "xml" in self.extras:
@@ -549,28 +761,9 @@ class Markdown(object):
     def _strip_link_definitions(self, text):
         # Strips link definitions from text, stores the URLs and titles in
         # hash references.
-        less_than_tab = self.tab_width - 1
-    
-        # Link defs are in the form:
-        #   [id]: url "optional title"
-        _link_def_re = re.compile(r"""
-            ^[ ]{0,%d}\[(.+)\]: # id = \1
-              [ \t]*
-              \n?               # maybe *one* newline
-              [ \t]*
-            <?(.+?)>?           # url = \2
-              [ \t]*
-            (?:
-                \n?             # maybe one newline
-                [ \t]*
-                (?<=\s)         # lookbehind for whitespace
-                ['"(]
-                ([^\n]*)        # title = \3
-                ['")]
-                [ \t]*
-            )?  # title is optional
-            (?:\n+|\Z)
-            """ % less_than_tab, re.X | re.M | re.U)
+        if '[' not in text:
+            return text
+        _link_def_re = _link_def_re_from_tab_width(self.tab_width)
         return _link_def_re.sub(self._extract_link_def_sub, text)
 
     def _extract_link_def_sub(self, match):
@@ -605,41 +798,32 @@ class Markdown(object):
             [^note-id]:
                 Text of the note.
         """
-        less_than_tab = self.tab_width - 1
-        footnote_def_re = re.compile(r'''
-            ^[ ]{0,%d}\[\^(.+)\]:   # id = \1
-            [ \t]*
-            (                       # footnote text = \2
-              # First line need not start with the spaces.
-              (?:\s*.*\n+)
-              (?:
-                (?:[ ]{%d} | \t)  # Subsequent lines must be indented.
-                .*\n+
-              )*
-            )
-            # Lookahead for non-space at line-start, or end of doc.
-            (?:(?=^[ ]{0,%d}\S)|\Z)
-            ''' % (less_than_tab, self.tab_width, self.tab_width),
-            re.X | re.M)
+        footnote_def_re = _footnote_def_re_from_tab_width(self.tab_width)
         return footnote_def_re.sub(self._extract_footnote_def_sub, text)
 
 
+    # Three or more markers, up to two spaces apart. The classic
+    # ^[ ]{0,2}([ ]?\*[ ]?){3,}[ \t]*$ matches the same lines, but it has
+    # two ways to match every space and takes exponential time to give up
+    # on a line like "- - - - - - - - - - x".
     _hr_res = [
-        re.compile(r"^[ ]{0,2}([ ]?\*[ ]?){3,}[ \t]*$", re.M),
-        re.compile(r"^[ ]{0,2}([ ]?\-[ ]?){3,}[ \t]*$", re.M),
-        re.compile(r"^[ ]{0,2}([ ]?\_[ ]?){3,}[ \t]*$", re.M),
+        ('*', re.compile(r"^[ ]{0,3}\*(?:[ ]{0,2}\*){2,}[ \t]*$", re.M)),
+        ('-', re.compile(r"^[ ]{0,3}\-(?:[ ]{0,2}\-){2,}[ \t]*$", re.M)),
+        ('_', re.compile(r"^[ ]{0,3}\_(?:[ ]{0,2}\_){2,}[ \t]*$", re.M)),
     ]
 
     def _run_block_gamut(self, text):
         # These are all the transformations that form block-level
         # tags like paragraphs, headers, and list items.
+        self._check_time_limit()
 
         text = self._do_headers(text)
 
         # Do Horizontal Rules:
         hr = "\n<hr"+self.empty_element_suffix+"\n"
-        for hr_re in self._hr_res:
-            text = hr_re.sub(hr, text)
+        for ch, hr_re in self._hr_res:
+            if ch in text:
+                text = hr_re.sub(hr, text)
 
         text = self._do_lists(text)
 
@@ -676,18 +860,13 @@ class Markdown(object):
         if ">>>" not in text:
             return text
 
-        less_than_tab = self.tab_width - 1
-        _pyshell_block_re = re.compile(r"""
-            ^([ ]{0,%d})>>>[ ].*\n   # first line
-            ^(\1.*\S+.*\n)*         # any number of subsequent lines
-            ^\n                     # ends with a blank line
-            """ % less_than_tab, re.M | re.X)
-
+        _pyshell_block_re = _pyshell_block_re_from_tab_width(self.tab_width)
         return _pyshell_block_re.sub(self._pyshell_block_sub, text)
 
     def _run_span_gamut(self, text):
         # These are all the transformations that occur *within* block-level
         # tags like paragraphs, headers, and list items.
+        self._check_time_limit()
     
         text = self._do_code_spans(text)
     
@@ -709,12 +888,12 @@ class Markdown(object):
         text = self._do_italics_and_bold(text)
     
         # Do hard breaks:
-        text = re.sub(r"\n", " <br%s\n" % self.empty_element_suffix, text)
+        text = text.replace("\n", " <br%s\n" % self.empty_element_suffix)
     
         return text
 
     # "Sorta" because auto-links are identified as "tag" tokens.
-    _sorta_html_tokenize_re = re.compile(r"""
+    _sorta_html_tokenize_re = _lazy_re(r"""
         (
             # tag
             </?         
@@ -723,13 +902,13 @@ class Markdown(object):
             \s*/?>
             |
             # auto-link (e.g., <http://www.activestate.com/>)
-            <\w+[^>]*>
+            <[\w%s][^>]*>
             |
             <!--.*?-->      # comment
             |
             <\?.*?\?>       # processing instruction
         )
-        """, re.X)
+        """ % _TOKEN_START, re.X)
     
     def _escape_special_chars(self, text):
         # Python markdown note: the HTML tokenization here differs from
@@ -738,6 +917,8 @@ class Markdown(object):
         # it isn't susceptible to unmatched '<' and '>' in HTML tags).
         # Note, however, that '>' is not allowed in an auto-link URL
         # here.
+        if '<' not in text and '\\' not in text:
+            return text
         escaped = []
         is_html_markup = False
         for token in self._sorta_html_tokenize_re.split(text):
@@ -757,6 +938,8 @@ class Markdown(object):
 
     def _hash_html_spans(self, text):
         # Used for safe_mode.
+        if '<' not in text:
+            return text
 
         def _is_auto_link(s):
             if ':' in s and self._auto_link_re.match(s):
@@ -770,18 +953,14 @@ class Markdown(object):
         for token in self._sorta_html_tokenize_re.split(text):
             if is_html_markup and not _is_auto_link(token):
                 sanitized = self._sanitize_html(token)
-                key = _hash_text(sanitized)
-                self.html_spans[key] = sanitized
-                tokens.append(key)
+                tokens.append(self._token(sanitized, self.html_spans))
             else:
                 tokens.append(token)
             is_html_markup = not is_html_markup
         return ''.join(tokens)
 
     def _unhash_html_spans(self, text):
-        for key, sanitized in self.html_spans.items():
-            text = text.replace(key, sanitized)
-        return text
+        return _unhash(text, self.html_spans)
 
     def _sanitize_html(self, s):
         if self.safe_mode == "replace":
@@ -799,24 +978,7 @@ class Markdown(object):
             raise MarkdownError("invalid value for 'safe_mode': %r (must be "
                                 "'escape' or 'replace')" % self.safe_mode)
 
-    _tail_of_inline_link_re = re.compile(r'''
-          # Match tail of: [text](/url/) or [text](/url/ "title")
-          \(            # literal paren
-            [ \t]*
-            (?P<url>            # \1
-                <.*?>
-                |
-                .*?
-            )
-            [ \t]*
-            (                   # \2
-              (['"])            # quote char = \3
-              (?P<title>.*?)
-              \3                # matching quote
-            )?                  # title is optional
-          \)
-        ''', re.X | re.S)
-    _tail_of_reference_link_re = re.compile(r'''
+    _tail_of_reference_link_re = _lazy_re(r'''
           # Match tail of: [text][id]
           [ ]?          # one optional space
           (?:\n[ ]*)?   # one optional newline followed by spaces
@@ -841,6 +1003,14 @@ class Markdown(object):
         # pos must be `>= anchor_allowed_pos`.
         anchor_allowed_pos = 0
 
+        # Matching brackets of `bracketed` within [bracket_pos, bracket_end),
+        # moved by `shift` in `text`; found again when a link text starts
+        # before them or may run past them.
+        bracketed = brackets = None
+        bracket_pos = bracket_end = shift = 0
+        # the last link looked at, and what it was replaced by
+        start_idx, result = 0, ''
+
         curr_pos = 0
         while True: # Handle the next link.
             # The next '[' is the start of:
@@ -858,28 +1028,45 @@ class Markdown(object):
             #   These have already been stripped in
             #   _strip_link_definitions() so no need to watch for them.
             # - not markup:         [...anything else...
+            self._check_time_limit()
+            if text is not bracketed and bracketed is not None:
+                # The link at `start_idx` was replaced by `result`: the
+                # brackets after it have only moved, and those of the
+                # anchor text in it, from `curr_pos` on, match among
+                # themselves.
+                shift += len(text) - len(bracketed)
+                bracket_pos = curr_pos - shift
+                for open_idx, close_idx in _match_brackets(
+                        text, curr_pos, start_idx + len(result)).items():
+                    brackets[open_idx - shift] = close_idx - shift
+                bracketed = text
             try:
                 start_idx = text.index('[', curr_pos)
             except ValueError:
                 break
             text_length = len(text)
+            sentinel = min(start_idx+MAX_LINK_TEXT_SENTINEL, text_length)
+            if text.find(']', start_idx+1, sentinel) == -1:
+                # No closing bracket within sentinel length.
+                curr_pos = start_idx + 1
+                continue
 
             # Find the matching closing ']'.
             # Markdown.pl allows *matching* brackets in link text so we
             # will here too. Markdown.pl *doesn't* currently allow
             # matching brackets in img alt text -- we'll differ in that
             # regard.
-            bracket_depth = 0
-            for p in range(start_idx+1, min(start_idx+MAX_LINK_TEXT_SENTINEL, 
-                                            text_length)):
-                ch = text[p]
-                if ch == ']':
-                    bracket_depth -= 1
-                    if bracket_depth < 0:
-                        break
-                elif ch == '[':
-                    bracket_depth += 1
-            else:
+            if bracketed is None or start_idx - shift < bracket_pos or \
+                    (sentinel - shift > bracket_end and
+                     bracket_end < text_length - shift):
+                bracketed = text
+                shift = 0
+                bracket_pos = start_idx
+                bracket_end = min(start_idx+2*MAX_LINK_TEXT_SENTINEL,
+                                  text_length)
+                brackets = _match_brackets(text, bracket_pos, bracket_end)
+            p = brackets.get(start_idx - shift, sentinel - shift) + shift
+            if p >= sentinel:
                 # Closing bracket not found within sentinel length.
                 # This isn't markup.
                 curr_pos = start_idx + 1
@@ -907,16 +1094,18 @@ class Markdown(object):
 
             # Inline anchor or img?
             if text[p] == '(': # attempt at perf improvement
-                match = self._tail_of_inline_link_re.match(text, p)
-                if match:
+                tail = _match_inline_link_tail(text, p)
+                if tail:
                     # Handle an inline anchor or img.
                     is_img = start_idx > 0 and text[start_idx-1] == "!"
                     if is_img:
                         start_idx -= 1
 
-                    url, title = match.group("url"), match.group("title")
+                    url, title, end = tail
                     if url and url[0] == '<':
-                        url = url[1:-1]  # '<url>' -> 'url'
+                        # '<url>' -> 'url'; a token stands for one character
+                        token = _trailing_token_re.search(url)
+                        url = url[1:token.start() if token else -1]
                     # We've got to encode these to avoid conflicting
                     # with italics/bold.
                     url = url.replace('*', g_escape_table['*']) \
@@ -933,7 +1122,7 @@ class Markdown(object):
                             % (url, link_text.replace('"', '&quot;'),
                                title_str, self.empty_element_suffix)
                         curr_pos = start_idx + len(result)
-                        text = text[:start_idx] + result + text[match.end():]
+                        text = text[:start_idx] + result + text[end:]
                     elif start_idx >= anchor_allowed_pos:
                         result_head = '<a href="%s"%s>' % (url, title_str)
                         result = '%s%s</a>' % (result_head, link_text)
@@ -941,7 +1130,7 @@ class Markdown(object):
                         # anchor_allowed_pos on.
                         curr_pos = start_idx + len(result_head)
                         anchor_allowed_pos = start_idx + len(result)
-                        text = text[:start_idx] + result + text[match.end():]
+                        text = text[:start_idx] + result + text[end:]
                     else:
                         # Anchor not allowed here.
                         curr_pos = start_idx + 1
@@ -1002,7 +1191,7 @@ class Markdown(object):
         return text 
 
 
-    _setext_h_re = re.compile(r'^(.+)[ \t]*\n(=+|-+)[ \t]*\n+', re.M)
+    _setext_h_re = _lazy_re(r'^(.+)[ \t]*\n(=+|-+)[ \t]*\n+', re.M)
     def _setext_h_sub(self, match):
         n = {"=": 1, "-": 2}[match.group(2)[0]]
         demote_headers = self.extras.get("demote-headers")
@@ -1011,7 +1200,7 @@ class Markdown(object):
         return "<h%d>%s</h%d>\n\n" \
                % (n, self._run_span_gamut(match.group(1)), n)
 
-    _atx_h_re = re.compile(r'''
+    _atx_h_re = _lazy_re(r'''
         ^(\#{1,6})  # \1 = string of #'s
         [ \t]*
         (.+?)       # \2 = Header text
@@ -1035,7 +1224,8 @@ class Markdown(object):
         #  
         #     Header 2
         #     --------
-        text = self._setext_h_re.sub(self._setext_h_sub, text)
+        if '=' in text or '-' in text:
+            text = self._setext_h_re.sub(self._setext_h_sub, text)
 
         # atx-style headers:
         #   # Header 1
@@ -1043,7 +1233,8 @@ class Markdown(object):
         #   ## Header 2 with closing hashes ##
         #   ...
         #   ###### Header 6
-        text = self._atx_h_re.sub(self._atx_h_sub, text)
+        if '#' in text:
+            text = self._atx_h_re.sub(self._atx_h_sub, text)
 
         return text
 
@@ -1062,33 +1253,17 @@ class Markdown(object):
         else:
             return "<%s>\n%s</%s>\n\n" % (lst_type, result, lst_type)
 
+    # Every list has a line starting with a marker and a space.
+    _list_marker_re = _lazy_re(r'^[ \t]*(?:[%s]|\d+\.)[ \t]' % _marker_ul_chars, re.M)
+
     def _do_lists(self, text):
         # Form HTML ordered (numbered) and unordered (bulleted) lists.
+        if not self._list_marker_re.search(text):
+            return text
+        if self.list_level + self.quote_level >= self.max_nesting:
+            return text
 
         for marker_pat in (self._marker_ul, self._marker_ol):
-            # Re-usable pattern to match any entire ul or ol list:
-            less_than_tab = self.tab_width - 1
-            whole_list = r'''
-                (                   # \1 = whole list
-                  (                 # \2
-                    [ ]{0,%d}
-                    (%s)            # \3 = first list item marker
-                    [ \t]+
-                  )
-                  (?:.+?)
-                  (                 # \4
-                      \Z
-                    |
-                      \n{2,}
-                      (?=\S)
-                      (?!           # Negative lookahead for another list item marker
-                        [ \t]*
-                        %s[ \t]+
-                      )
-                  )
-                )
-            ''' % (less_than_tab, marker_pat, marker_pat)
-        
             # We use a different prefix before nested lists than top-level lists.
             # See extended comment in _process_list_items().
             #
@@ -1108,16 +1283,15 @@ class Markdown(object):
             # static s/// patterns rather than one conditional pattern.
 
             if self.list_level:
-                sub_list_re = re.compile("^"+whole_list, re.X | re.M | re.S)
+                sub_list_re = _list_re_from_tab_width(self.tab_width, marker_pat, True)
                 text = sub_list_re.sub(self._list_sub, text)
             else:
-                list_re = re.compile(r"(?:(?<=\n\n)|\A\n?)"+whole_list,
-                                     re.X | re.M | re.S)
+                list_re = _list_re_from_tab_width(self.tab_width, marker_pat, False)
                 text = list_re.sub(self._list_sub, text)
 
         return text
     
-    _list_item_re = re.compile(r'''
+    _list_item_re = _lazy_re(r'''
         (\n)?               # leading line = \1
         (^[ \t]*)           # leading whitespace = \2
         (%s) [ \t]+         # list marker = \3
@@ -1129,6 +1303,7 @@ class Markdown(object):
 
     _last_li_endswith_two_eols = False
     def _list_item_sub(self, match):
+        self._check_time_limit()
         item = match.group(4)
         leading_line = match.group(1)
         leading_space = match.group(2)
@@ -1175,35 +1350,25 @@ class Markdown(object):
         return list_str
 
     def _get_pygments_lexer(self, lexer_name):
-        try:
-            from pygments import lexers, util
-        except ImportError:
-            return None
-        try:
-            return lexers.get_lexer_by_name(lexer_name)
-        except util.ClassNotFound:
-            return None
+        return _pygments_lexer(lexer_name)
 
     def _color_with_pygments(self, codeblock, lexer, **formatter_opts):
-        import pygments
-        import pygments.formatters
-
-        class HtmlCodeFormatter(pygments.formatters.HtmlFormatter):
-            def _wrap_code(self, inner):
-                """A function for use in a Pygments Formatter which
-                wraps in <code> tags.
-                """
-                yield 0, "<code>"
-                for tup in inner:
-                    yield tup 
-                yield 0, "</code>"
-
-            def wrap(self, source, outfile):
-                """Return the source with a code, pre, and div."""
-                return self._wrap_div(self._wrap_pre(self._wrap_code(source)))
-
-        formatter = HtmlCodeFormatter(cssclass="codehilite", **formatter_opts)
-        return pygments.highlight(codeblock, lexer, formatter)
+        # Lexers and formatters are shared, and the HTML of recently
+        # highlighted blocks is kept: pasted snippets tend to repeat.
+        options = tuple(sorted(formatter_opts.items()))
+        key = (lexer, sha1(codeblock.encode("utf-8")).hexdigest(), options)
+        try:
+            return _pygments_highlighted[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # unhashable option values -- no caching
+            return _pygments_highlight(codeblock, lexer,
+                                       _pygments_formatter(options))
+        colored = _pygments_highlight(codeblock, lexer,
+                                      _pygments_formatter(options))
+        _pygments_highlighted[key] = colored
+        return colored
 
     def _code_block_sub(self, match):
         codeblock = match.group(1)
@@ -1228,18 +1393,9 @@ class Markdown(object):
 
     def _do_code_blocks(self, text):
         """Process Markdown `<pre><code>` blocks."""
-        code_block_re = re.compile(r'''
-            (?:\n\n|\A)
-            (               # $1 = the code block -- one or more lines, starting with a space/tab
-              (?:
-                (?:[ ]{%d} | \t)  # Lines must start with a tab or a tab-width of spaces
-                .*\n+
-              )+
-            )
-            ((?=^[ ]{0,%d}\S)|\Z)   # Lookahead for non-space at line-start, or end of doc
-            ''' % (self.tab_width, self.tab_width),
-            re.M | re.X)
-
+        if ' ' * self.tab_width not in text and '\t' not in text:
+            return text
+        code_block_re = _code_block_re_from_tab_width(self.tab_width)
         return code_block_re.sub(self._code_block_sub, text)
 
 
@@ -1250,19 +1406,9 @@ class Markdown(object):
     # - cannot start or end a code span with a backtick; pad with a
     #   space and that space will be removed in the emitted HTML
     # See `test/tm-cases/escapes.text` for a number of edge-case
-    # examples.
-    _code_span_re = re.compile(r'''
-            (?<!\\)
-            (`+)        # \1 = Opening run of `
-            (?!`)       # See Note A test/tm-cases/escapes.text
-            (.+?)       # \2 = The code block
-            (?<!`)
-            \1          # Matching closer
-            (?!`)
-        ''', re.X | re.S)
-
-    def _code_span_sub(self, match):
-        c = match.group(2).strip(" \t")
+    # examples, and _sub_code_spans() for how spans are found.
+    def _code_span_sub(self, code):
+        c = code.strip(" \t")
         c = self._encode_code(c)
         return "<code>%s</code>" % c
 
@@ -1289,7 +1435,9 @@ class Markdown(object):
         #       Turns to:
         #     
         #         ... type <code>`bar`</code> ...
-        return self._code_span_re.sub(self._code_span_sub, text)
+        if '`' not in text:
+            return text
+        return _sub_code_spans(text, self._code_span_sub)
 
     def _encode_code(self, text):
         """Encode/escape certain characters inside Markdown code runs.
@@ -1316,22 +1464,20 @@ class Markdown(object):
             text = text.replace(before, after)
         return text
 
-    _strong_re = re.compile(r"(\*\*|__)(?=\S)(.+?[*_]*)(?<=\S)\1", re.S)
-    _em_re = re.compile(r"(\*|_)(?=\S)(.+?)(?<=\S)\1", re.S)
-    _code_friendly_strong_re = re.compile(r"\*\*(?=\S)(.+?[*_]*)(?<=\S)\*\*", re.S)
-    _code_friendly_em_re = re.compile(r"\*(?=\S)(.+?)(?<=\S)\*", re.S)
     def _do_italics_and_bold(self, text):
+        if '*' not in text and '_' not in text:
+            return text
         # <strong> must go first:
         if "code-friendly" in self.extras:
-            text = self._code_friendly_strong_re.sub(r"<strong>\1</strong>", text)
-            text = self._code_friendly_em_re.sub(r"<em>\1</em>", text)
+            text = _sub_emphasis(text, ('**',), "strong", extend=True)
+            text = _sub_emphasis(text, ('*',), "em")
         else:
-            text = self._strong_re.sub(r"<strong>\2</strong>", text)
-            text = self._em_re.sub(r"<em>\2</em>", text)
+            text = _sub_emphasis(text, ('**', '__'), "strong", extend=True)
+            text = _sub_emphasis(text, ('*', '_'), "em")
         return text
     
 
-    _block_quote_re = re.compile(r'''
+    _block_quote_re = _lazy_re(r'''
         (                           # Wrap whole match in \1
           (
             ^[ \t]*>[ \t]?          # '>' at the start of a line
@@ -1341,9 +1487,9 @@ class Markdown(object):
           )+
         )
         ''', re.M | re.X)
-    _bq_one_level_re = re.compile('^[ \t]*>[ \t]?', re.M);
+    _bq_one_level_re = _lazy_re('^[ \t]*>[ \t]?', re.M);
 
-    _html_pre_block_re = re.compile(r'(\s*<pre>.+?</pre>)', re.S)
+    _html_pre_block_re = _lazy_re(r'(\s*<pre>.+?</pre>)', re.S)
     def _dedent_two_spaces_sub(self, match):
         return re.sub(r'(?m)^  ', '', match.group(1))
 
@@ -1351,7 +1497,9 @@ class Markdown(object):
         bq = match.group(1)
         bq = self._bq_one_level_re.sub('', bq)  # trim one level of quoting
         bq = self._ws_only_line_re.sub('', bq)  # trim whitespace-only lines
+        self.quote_level += 1
         bq = self._run_block_gamut(bq)          # recurse
+        self.quote_level -= 1
 
         bq = re.sub('(?m)^', '  ', bq)
         # These leading spaces screw with <pre> content, so we need to fix that:
@@ -1362,8 +1510,18 @@ class Markdown(object):
     def _do_block_quotes(self, text):
         if '>' not in text:
             return text
+        if self.list_level + self.quote_level >= self.max_nesting:
+            return text
         return self._block_quote_re.sub(self._block_quote_sub, text)
 
+    def _form_plain_paragraphs(self, text):
+        # What _form_paragraphs() makes of text that _markup_re finds
+        # nothing in: the rest of the pipeline leaves such text alone.
+        br = " <br%s\n" % self.empty_element_suffix
+        grafs = re.split(r"\n{2,}", text.strip('\n'))
+        return "\n\n".join(["<p>" + graf.replace("\n", br) + "</p>"
+                              for graf in grafs])
+
     def _form_paragraphs(self, text):
         # Strip leading and trailing lines:
         text = text.strip('\n')
@@ -1411,22 +1569,25 @@ class Markdown(object):
 
     # Ampersand-encoding based entirely on Nat Irons's Amputator MT plugin:
     #   http://bumppo.net/projects/amputator/
-    _ampersand_re = re.compile(r'&(?!#?[xX]?(?:[0-9a-fA-F]+|\w+);)')
-    _naked_lt_re = re.compile(r'<(?![a-z/?\$!])', re.I)
-    _naked_gt_re = re.compile(r'''(?<![a-z?!/'"-])>''', re.I)
+    _ampersand_re = _lazy_re(r'&(?!#?[xX]?(?:[0-9a-fA-F]+|\w+);)')
+    _naked_lt_re = _lazy_re(u'<(?![a-z/?\\$!%s%s])' % (_escape_chars, _TOKEN_START), re.I)
+    _naked_gt_re = _lazy_re(u'''(?<![a-z?!/'"%s-])>''' % _escape_chars_ending_in_letter, re.I)
 
     def _encode_amps_and_angles(self, text):
         # Smart processing for ampersands and angle brackets that need
         # to be encoded.
-        text = self._ampersand_re.sub('&amp;', text)
+        if '&' in text:
+            text = self._ampersand_re.sub('&amp;', text)
     
         # Encode naked <'s
-        text = self._naked_lt_re.sub('&lt;', text)
+        if '<' in text:
+            text = self._naked_lt_re.sub('&lt;', text)
 
         # Encode naked >'s
         # Note: Other markdown implementations (e.g. Markdown.pl, PHP
         # Markdown) don't do this.
-        text = self._naked_gt_re.sub('&gt;', text)
+        if '>' in text:
+            text = self._naked_gt_re.sub('&gt;', text)
         return text
 
     def _encode_backslash_escapes(self, text):
@@ -1434,27 +1595,28 @@ class Markdown(object):
             text = text.replace("\\"+ch, escape)
         return text
 
-    _auto_link_re = re.compile(r'<((https?|ftp):[^\'">\s]+)>', re.I)
-    def _auto_link_sub(self, match):
-        g1 = match.group(1)
-        return '<a href="%s">%s</a>' % (g1, g1)
+    _auto_link_re = _lazy_re(r'<((https?|ftp):[^\'">\s]+)>', re.I)
+    def _auto_link_sub(self, url):
+        return '<a href="%s">%s</a>' % (url, url)
 
-    _auto_email_link_re = re.compile(r"""
+    _auto_email_link_re = _lazy_re(r"""
           <
            (?:mailto:)?
           (
-              [-.\w]+
+              [-.\w%s]+
               \@
-              [-\w]+(\.[-\w]+)*\.[a-z]+
+              [-\w%s]+(\.[-\w%s]+)*\.[a-z]+
           )
           >
-        """, re.I | re.X | re.U)
+        """ % ((_escape_chars,) * 3), re.I | re.X | re.U)
     def _auto_email_link_sub(self, match):
         return self._encode_email_address(
             self._unescape_special_chars(match.group(1)))
 
     def _do_auto_links(self, text):
-        text = self._auto_link_re.sub(self._auto_link_sub, text)
+        if '<' not in text:
+            return text
+        text = _sub_auto_links(text, self._auto_link_sub)
         text = self._auto_email_link_re.sub(self._auto_email_link_sub, text)
         return text
 
@@ -1471,7 +1633,12 @@ class Markdown(object):
         #
         #  Based on a filter by Matthew Wickline, posted to the BBEdit-Talk
         #  mailing list: <http://tinyurl.com/yu7ue>
-        chars = [_xml_encode_email_char_at_random(ch)
+        if self.deterministic:
+            seed = int(md5(addr.encode("utf-8")).hexdigest(), 16)
+            rand = Random(seed).random
+        else:
+            rand = random
+        chars = [_xml_encode_email_char_at_random(ch, rand)
                  for ch in "mailto:" + addr]
         # Strip the mailto: from the visible part.
         addr = '<a href="%s">%s</a>' \
@@ -1488,32 +1655,35 @@ class Markdown(object):
         """
         link_from_hash = {}
         for regex, repl in self.link_patterns:
-            replacements = []
+            pieces = []
+            last = 0
             for match in regex.finditer(text):
                 if hasattr(repl, "__call__"):
                     href = repl(match)
                 else:
                     href = match.expand(repl)
-                replacements.append((match.span(), href))
-            for (start, end), href in reversed(replacements):
+                start, end = match.span()
                 escaped_href = (
                     href.replace('"', '&quot;')  # b/c of attr quote
                         # To avoid markdown <em> and <strong>:
                         .replace('*', g_escape_table['*'])
                         .replace('_', g_escape_table['_']))
                 link = '<a href="%s">%s</a>' % (escaped_href, text[start:end])
-                hash = md5(link).hexdigest()
-                link_from_hash[hash] = link
-                text = text[:start] + hash + text[end:]
-        for hash, link in link_from_hash.items():
-            text = text.replace(hash, link)
-        return text
+                pieces.append(text[last:start])
+                pieces.append(self._token(link, link_from_hash))
+                last = end
+            if pieces:
+                pieces.append(text[last:])
+                text = ''.join(pieces)
+        if not link_from_hash:
+            return text
+        return _unhash(text, link_from_hash)
     
     def _unescape_special_chars(self, text):
         # Swap back in all the special characters we've hidden.
-        for ch, hash in g_escape_table.items():
-            text = text.replace(hash, ch)
-        return text
+        if not _escaped_char_re.search(text):
+            return text
+        return text.translate(g_unescape_table)
 
     def _outdent(self, text):
         # Remove one level of line-leading tabs or spaces
@@ -1665,17 +1835,22 @@ def _dedent(text, tabsize=8, skip_first_line=False):
 class _memoized(object):
    """Decorator that caches a function's return value each time it is called.
    If called later with the same arguments, the cached value is returned, and
-   not re-evaluated.
+   not re-evaluated. Like re's own cache, it is emptied when it holds
+   `maxsize` values, so converters with many tab widths cannot grow it
+   without bound.
 
    http://wiki.python.org/moin/PythonDecoratorLibrary
    """
-   def __init__(self, func):
+   def __init__(self, func, maxsize=32):
       self.func = func
+      self.maxsize = maxsize
       self.cache = {}
    def __call__(self, *args):
       try:
          return self.cache[args]
       except KeyError:
+         if len(self.cache) >= self.maxsize:
+            self.cache.clear()
          self.cache[args] = value = self.func(*args)
          return value
       except TypeError:
@@ -1687,6 +1862,172 @@ class _memoized(object):
       return self.func.__doc__
 
 
+# Regexes that depend on the tab width, compiled once per width:
+
+def _outdent_re_from_tab_width(tab_width):
+    """One level of line-leading indentation."""
+    return re.compile(r'^(\t|[ ]{1,%d})' % tab_width, re.M)
+_outdent_re_from_tab_width = _memoized(_outdent_re_from_tab_width)
+
+def _link_def_re_from_tab_width(tab_width):
+    """Link definition: [id]: url "optional title"."""
+    return re.compile(r"""
+        ^[ ]{0,%d}\[(.+)\]: # id = \1
+          [ \t]*
+          \n?               # maybe *one* newline
+          [ \t]*
+        <?(.+?)>?           # url = \2
+          [ \t]*
+        (?:
+            \n?             # maybe one newline
+            [ \t]*
+            (?<=\s)         # lookbehind for whitespace
+            ['"(]
+            ([^\n]*)        # title = \3
+            ['")]
+            [ \t]*
+        )?  # title is optional
+        (?:\n+|\Z)
+        """ % (tab_width - 1), re.X | re.M | re.U)
+_link_def_re_from_tab_width = _memoized(_link_def_re_from_tab_width)
+
+def _footnote_def_re_from_tab_width(tab_width):
+    """Footnote definition: [^note-id]: Text of the note."""
+    return re.compile(r'''
+        ^[ ]{0,%d}\[\^(.+)\]:   # id = \1
+        [ \t]*
+        (                       # footnote text = \2
+          # First line need not start with the spaces.
+          (?:\s*.*\n+)
+          (?:
+            (?:[ ]{%d} | \t)  # Subsequent lines must be indented.
+            .*\n+
+          )*
+        )
+        # Lookahead for non-space at line-start, or end of doc.
+        (?:(?=^[ ]{0,%d}\S)|\Z)
+        ''' % (tab_width - 1, tab_width, tab_width),
+        re.X | re.M)
+_footnote_def_re_from_tab_width = _memoized(_footnote_def_re_from_tab_width)
+
+def _pyshell_block_re_from_tab_width(tab_width):
+    """Python interactive shell session."""
+    return re.compile(r"""
+        ^([ ]{0,%d})>>>[ ].*\n   # first line
+        ^(\1.*\S+.*\n)*         # any number of subsequent lines
+        ^\n                     # ends with a blank line
+        """ % (tab_width - 1), re.M | re.X)
+_pyshell_block_re_from_tab_width = _memoized(_pyshell_block_re_from_tab_width)
+
+def _list_re_from_tab_width(tab_width, marker_pat, nested):
+    """Whole ul or ol list whose first marker matches `marker_pat`, at the
+    start of a line if `nested` or else after a blank line."""
+    whole_list = r'''
+        (                   # \1 = whole list
+          (                 # \2
+            [ ]{0,%d}
+            (%s)            # \3 = first list item marker
+            [ \t]+
+          )
+          (?:.+?)
+          (                 # \4
+              \Z
+            |
+              \n{2,}
+              (?=\S)
+              (?!           # Negative lookahead for another list item marker
+                [ \t]*
+                %s[ \t]+
+              )
+          )
+        )
+    ''' % (tab_width - 1, marker_pat, marker_pat)
+    if nested:
+        return re.compile("^"+whole_list, re.X | re.M | re.S)
+    return re.compile(r"(?:(?<=\n\n)|\A\n?)"+whole_list, re.X | re.M | re.S)
+_list_re_from_tab_width = _memoized(_list_re_from_tab_width)
+
+def _code_block_re_from_tab_width(tab_width):
+    """Indented code block."""
+    return re.compile(r'''
+        (?:\n\n|\A)
+        (               # $1 = the code block -- one or more lines, starting with a space/tab
+          (?:
+            (?:[ ]{%d} | \t)  # Lines must start with a tab or a tab-width of spaces
+            .*\n+
+          )+
+        )
+        ((?=^[ ]{0,%d}\S)|\Z)   # Lookahead for non-space at line-start, or end of doc
+        ''' % (tab_width, tab_width),
+        re.M | re.X)
+_code_block_re_from_tab_width = _memoized(_code_block_re_from_tab_width)
+
+class _LRUCache(object):
+    """A dict-like cache of at most `maxsize` items, which drops the least
+    recently used one to make room. Safe to share between threads."""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+    def __getitem__(self, key):
+        with self.lock:
+            value = self.data.pop(key)
+            self.data[key] = value
+            return value
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+    def __len__(self):
+        return len(self.data)
+
+
+# code-color extra: pygments is only imported when a code block names a
+# language, and lexers and formatters are made once and shared.
+
+def _pygments_lexer(lexer_name):
+    """Lexer for `lexer_name`, or None if there is no such lexer or no
+    pygments."""
+    try:
+        from pygments import lexers, util
+    except ImportError:
+        return None
+    try:
+        return lexers.get_lexer_by_name(lexer_name)
+    except util.ClassNotFound:
+        return None
+_pygments_lexer = _memoized(_pygments_lexer, maxsize=128)
+
+def _pygments_formatter(options):
+    """HTML formatter for `options`, a sorted tuple of (name, value)."""
+    import pygments.formatters
+
+    class HtmlCodeFormatter(pygments.formatters.HtmlFormatter):
+        def _wrap_code(self, inner):
+            """A function for use in a Pygments Formatter which
+            wraps in <code> tags.
+            """
+            yield 0, "<code>"
+            for tup in inner:
+                yield tup 
+            yield 0, "</code>"
+
+        def wrap(self, source, outfile):
+            """Return the source with a code, pre, and div."""
+            return self._wrap_div(self._wrap_pre(self._wrap_code(source)))
+
+    return HtmlCodeFormatter(cssclass="codehilite", **dict(options))
+_pygments_formatter = _memoized(_pygments_formatter)
+
+def _pygments_highlight(codeblock, lexer, formatter):
+    import pygments
+    return pygments.highlight(codeblock, lexer, formatter)
+
+# (lexer, SHA-1 of the code, formatter options) -> highlighted HTML
+_pygments_highlighted = _LRUCache(256)
+
 def _xml_oneliner_re_from_tab_width(tab_width):
     """Standalone XML processing instruction regex."""
     return re.compile(r"""
@@ -1728,7 +2069,7 @@ def _hr_tag_re_from_tab_width(tab_width):
 _hr_tag_re_from_tab_width = _memoized(_hr_tag_re_from_tab_width)
 
 
-def _xml_encode_email_char_at_random(ch):
+def _xml_encode_email_char_at_random(ch, random=random):
     r = random()
     # Roughly 10% raw, 45% hex, 45% dec.
     # '@' *must* be encoded. I [John Gruber] insist.
@@ -1741,22 +2082,261 @@ def _xml_encode_email_char_at_random(ch):
     else:
         return '&#%s;' % ord(ch)
 
-def _hash_text(text):
-    return 'md5:'+md5(text.encode("utf-8")).hexdigest()
+# What \s matches in a regex without re.UNICODE.
+_ascii_whitespace = ' \t\n\r\f\v'
+_emphasis_run_re = re.compile(r'[*_]*')
 
+def _sub_emphasis(text, delims, tag, extend=False):
+    r"""Wrap <`tag`> around text between a pair of one of `delims`.
+
+    The result is that of re.sub(r"(D)(?=\S)(.+?)(?<=\S)\1", r"<tag>\2</tag>",
+    text) with D matching each of `delims` -- or, with `extend`, of
+    (.+?[*_]*) in the middle, so that the closing delimiter goes as far right
+    as its run of * and _ allows. On text with many unmatched delimiters
+    that regex takes quadratic time and worse; here every delimiter is looked
+    at a bounded number of times.
+
+        >>> _sub_emphasis(u'**a***', ('**', '__'), 'strong', extend=True)
+        u'<strong>a*</strong>'
+        >>> _sub_emphasis(u'*a * b*', ('*', '_'), 'em')
+        u'<em>a * b</em>'
+    """
+    n = len(text)
+    openers = []
+    closers = {}
+    for delim in delims:
+        size = len(delim)
+        found = []
+        i = text.find(delim)
+        while i != -1:
+            found.append(i)
+            i = text.find(delim, i + 1)
+        openers.extend([(at, delim) for at in found
+                        if at + size < n and text[at+size] not in _ascii_whitespace])
+        closers[delim] = [at for at in found
+                          if at and text[at-1] not in _ascii_whitespace]
+    openers.sort()
+
+    # Openers are tried left to right and a closer must come after its
+    # opener, so the next closer to try for each delimiter only moves right.
+    next_closer = dict.fromkeys(delims, 0)
+    pieces = []
+    pos = 0
+    for start, delim in openers:
+        if start < pos:
+            continue
+        size = len(delim)
+        found = closers[delim]
+        k = next_closer[delim]
+        while k < len(found) and found[k] <= start + size:
+            k += 1
+        if k < len(found) and extend:
+            run_end = _emphasis_run_re.match(text, found[k]).end()
+            while k + 1 < len(found) and found[k+1] + size <= run_end:
+                k += 1
+        next_closer[delim] = k
+        if k == len(found):
+            continue
+        end = found[k]
+        pieces.append(text[pos:start])
+        pieces.append("<%s>%s</%s>" % (tag, text[start+size:end], tag))
+        pos = end + size
+    if not pieces:
+        return text
+    pieces.append(text[pos:])
+    return ''.join(pieces)
+
+_backtick_run_re = re.compile(r'`+')
+
+def _sub_code_spans(text, repl):
+    r"""Replace each code span in `text` by `repl` of its contents.
+
+    The result is that of re.sub(r"(?<!\\)(`+)(?!`)(.+?)(?<!`)\1(?!`)",
+    lambda m: repl(m.group(2)), text, flags=re.S): a span opens with a run
+    of backticks, or the longest tail of it that has a closer if the whole
+    run has none or follows a backslash, and closes with the next run of
+    exactly as many. That regex takes quadratic time on a long run of
+    backticks; here the closing run for each possible opening is looked up.
+
+        >>> _sub_code_spans(u'a ``b`c`` `d', lambda code: u'<%s>' % code)
+        u'a <b`c> `d'
+    """
+    runs = [m.span() for m in _backtick_run_re.finditer(text)]
+    by_size = {}
+    for index, (start, end) in enumerate(runs):
+        by_size.setdefault(end - start, []).append(index)
+    pieces = []
+    pos = 0
+    index = 0
+    while index < len(runs):
+        start, end = runs[index]
+        closer = None
+        for opening in range(start, end):
+            if opening == start and start and text[start-1] == '\\':
+                continue
+            later = by_size.get(end - opening)
+            if later:
+                k = bisect.bisect_right(later, index)
+                if k < len(later):
+                    closer = later[k]
+                    break
+        if closer is None:
+            index += 1
+            continue
+        close_start, close_end = runs[closer]
+        pieces.append(text[pos:opening])
+        pieces.append(repl(text[end:close_start]))
+        pos = close_end
+        index = closer + 1
+    if not pieces:
+        return text
+    pieces.append(text[pos:])
+    return ''.join(pieces)
+
+_url_chars_re = re.compile(r'[^\'">\s]+')
+_url_scheme_re = re.compile(r'(?:https?|ftp):', re.I)
+
+def _sub_auto_links(text, repl):
+    r"""Replace each `<url>` in `text` by `repl` of the url.
+
+    The result is that of re.sub(r'<((https?|ftp):[^\'">\s]+)>',
+    lambda m: repl(m.group(1)), text, flags=re.I). That regex takes
+    quadratic time on text like '<http://<http://...' with no '>': every
+    '<' starts a scan to the end of the same run of url characters. Here
+    each run is looked at once: it holds a link if a '>' ends it, and the
+    link starts at the first '<' in it followed by a scheme and something.
+
+        >>> _sub_auto_links(u'<<http://a<b> <ftp:>', lambda url: u'[%s]' % url)
+        u'<[http://a<b] <ftp:>'
+    """
+    if '>' not in text:
+        return text
+    pieces = []
+    pos = 0
+    for run in _url_chars_re.finditer(text):
+        start, end = run.span()
+        if text[end:end+1] != '>':
+            continue
+        i = text.find('<', start, end)
+        while i != -1:
+            scheme = _url_scheme_re.match(text, i + 1)
+            if scheme and scheme.end() < end:
+                pieces.append(text[pos:i])
+                pieces.append(repl(text[i+1:end]))
+                pos = end + 1
+                break
+            i = text.find('<', i + 1, end)
+    if not pieces:
+        return text
+    pieces.append(text[pos:])
+    return ''.join(pieces)
+
+_bracket_re = re.compile(r'[\[\]]')
+
+def _match_brackets(text, pos, endpos):
+    r"""Map the position of each '[' in `text[pos:endpos]` to that of its
+    matching ']' there, the first one at which the brackets after it run
+    out. Finding these one '[' at a time takes quadratic time on a long run
+    of them.
+
+        >>> sorted(_match_brackets(u'[a [b] c] ] [', 0, 13).items())
+        [(0, 8), (3, 5)]
+    """
+    matches = {}
+    opened = []
+    for m in _bracket_re.finditer(text, pos, endpos):
+        if m.group() == '[':
+            opened.append(m.start())
+        elif opened:
+            matches[opened.pop()] = m.start()
+    return matches
+
+def _match_inline_link_tail(text, pos):
+    r"""The url, title and end of the tail of an inline link, e.g.
+    `(/url/ "title")`, at `pos` in `text`, or None.
+
+    The result is that of the match at `pos` of
+    r"\([ \t]*(?P<url><.*?>|.*?)[ \t]*((['"])(?P<title>.*?)\3)?\)" with
+    re.S. That regex takes quadratic time, e.g. on a run of quotes that is
+    not closed by one before a ')'; here each candidate end of the url is
+    looked at once, and the end of a title is looked up.
+
+        >>> _match_inline_link_tail(u'(<a> "b" c") d)', 0)
+        (u'<a>', u'b" c', 12)
+    """
+    n = len(text)
+    if pos >= n or text[pos] != '(':
+        return None
+    start = pos + 1
+    while start < n and text[start] in ' \t':
+        start += 1
+    if text.find(')', start) == -1:
+        return None
+    # quote -> (searched from, position of quote + ')' or -1)
+    closers = {}
+
+    def rest(u):
+        # title and end if the regex matches from the end of the url at u
+        while u < n and text[u] in ' \t':
+            u += 1
+        if u == n:
+            return None
+        ch = text[u]
+        if ch == '"' or ch == "'":
+            searched, found = closers.get(ch, (n + 1, -1))
+            if not (searched <= u + 1 and (found == -1 or u + 1 <= found)):
+                searched, found = u + 1, text.find(ch + ')', u + 1)
+                closers[ch] = (searched, found)
+            if found != -1:
+                return text[u+1:found], found + 2
+        elif ch == ')':
+            return None, u + 1
+        return None
+
+    if start < n and text[start] == '<':
+        g = text.find('>', start + 1)
+        while g != -1:
+            tail = rest(g + 1)
+            if tail:
+                return (text[start:g+1],) + tail
+            g = text.find('>', g + 1)
+    for u in range(start, n):
+        tail = rest(u)
+        if tail:
+            return (text[start:u],) + tail
+    return None
+
+def _unhash(text, table):
+    """Put back, in a single pass over `text`, the `table` value of every
+    token. Tokens from other tables are left alone.
+    """
+    parts = _token_re.split(text)
+    parts[1::2] = [table.get(key, key) for key in parts[1::2]]
+    return ''.join(parts)
 
-#---- mainline
 
-class _NoReflowFormatter(optparse.IndentedHelpFormatter):
-    """An optparse formatter that does NOT reflow the description."""
-    def format_description(self, description):
-        return description or ""
+#---- mainline
 
 def _test():
     import doctest
     doctest.testmod()
 
+def _bench(args):
+    try:
+        from utils import markdown_bench
+    except ImportError:
+        import markdown_bench
+    return markdown_bench.main(args)
+
 def main(argv=None):
+    # Imported here, as the module is mostly used as a library.
+    import optparse
+
+    class _NoReflowFormatter(optparse.IndentedHelpFormatter):
+        """An optparse formatter that does NOT reflow the description."""
+        def format_description(self, description):
+            return description or ""
+
     if argv is None:
         argv = sys.argv
     if not logging.root.handlers:
@@ -1797,6 +2377,9 @@ def main(argv=None):
                       help="run internal self-tests (some doctests)")
     parser.add_option("--compare", action="store_true",
                       help="run against Markdown.pl as well (for testing)")
+    parser.add_option("--bench", action="store_true",
+                      help="run the benchmark suite in markdown_bench.py; "
+                           "its options go after '--'")
     parser.set_defaults(log_level=logging.INFO, compare=False,
                         encoding="utf-8", safe_mode=None, use_file_vars=False)
     opts, paths = parser.parse_args()
@@ -1804,6 +2387,8 @@ def main(argv=None):
 
     if opts.self_test:
         return _test()
+    if opts.bench:
+        return _bench(paths)
 
     if opts.extras:
         extras = {}
@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmarks for utils.markdown, the renderer behind every status.
+
+The suite converts fixed corpora, built from a seeded generator so that
+every run sees the same texts, and reports for each the best time per item
+over a few runs, and how that time splits over the main stages of the
+converter, on average (a stage's time includes the stages it calls).
+
+    python -m utils.markdown_bench [--repeat N] [--save FILE] [--baseline FILE]
+    python utils/markdown.py --bench -- [options]
+
+With --baseline, each corpus is compared with the times saved earlier with
+--save, and the exit status is 1 when one got slower by more than
+--tolerance. Times depend on the machine: save the baseline on the one you
+compare on, e.g. before and after a change.
+
+--scaling prints instead how the time per item grows with the number of
+placeholders (inline HTML spans, link pattern links) in one text.
+"""
+import gc
+import json
+import optparse
+import random
+import re
+import sys
+import timeit
+
+try:
+    from utils.markdown import Markdown
+except ImportError:
+    # run as a script from the utils directory
+    from markdown import Markdown
+
+#---- corpora
+
+WORDS = [u'今天', u'天气', u'不错', u'我们', u'开会', u'讨论', u'预算', u'周末', u'一起',
+         u'吃饭', u'项目', u'进度', u'ok', u'deploy', u'review', u'meeting', u'lunch',
+         u'the', u'patch', u'is', u'ready', u'tomorrow', u'thanks']
+NAMES = [u'张三', u'李四', u'王五', u'alice', u'bob']
+
+
+def _sentence(rng, n):
+    return u' '.join(rng.choice(WORDS) for i in range(n))
+
+
+def _chat(rng):
+    # one or two short lines, now and then a mention or a URL
+    text = _sentence(rng, rng.randint(2, 12))
+    if rng.random() < 0.3:
+        text = u'@%s %s' % (rng.choice(NAMES), text)
+    if rng.random() < 0.1:
+        text += u' http://t.cn/%d' % rng.randint(1000, 9999)
+    if rng.random() < 0.2:
+        text += u'\n' + _sentence(rng, rng.randint(2, 8))
+    return text
+
+
+def _post(rng):
+    grafs = [u'# %s' % _sentence(rng, 3)]
+    for i in range(rng.randint(4, 10)):
+        words = _sentence(rng, rng.randint(20, 60)).split(u' ')
+        words[rng.randrange(len(words))] = u'**%s**' % rng.choice(WORDS)
+        words[rng.randrange(len(words))] = u'*%s*' % rng.choice(WORDS)
+        words[rng.randrange(len(words))] = u'[%s](http://example.com/%d)' % (
+            rng.choice(WORDS), rng.randint(1, 99))
+        words[rng.randrange(len(words))] = u'`%s()`' % rng.choice(WORDS)
+        grafs.append(u' '.join(words))
+    return u'\n\n'.join(grafs)
+
+
+def _code(rng):
+    lines = [u'    def f%d(x):' % rng.randint(0, 99)]
+    for i in range(rng.randint(5, 30)):
+        lines.append(u'        x = x * %d + a[%d] & 0x%x  # <%s>' % (
+            i, i, i, rng.choice(WORDS)))
+    return u'%s:\n\n%s\n\n%s' % (_sentence(rng, 6), u'\n'.join(lines), _sentence(rng, 6))
+
+
+def _lists(rng):
+    lines = []
+    for i in range(rng.randint(3, 8)):
+        lines.append(u'%d. %s' % (i + 1, _sentence(rng, 4)))
+        for j in range(rng.randint(0, 4)):
+            lines.append(u'    - %s' % _sentence(rng, 3))
+            for k in range(rng.randint(0, 2)):
+                lines.append(u'        * *%s*' % _sentence(rng, 2))
+    return u'\n'.join(lines)
+
+
+def _html(rng):
+    parts = []
+    for i in range(rng.randint(5, 20)):
+        parts.append(rng.choice([
+            u'<b id="b%d">%s</b>' % (i, rng.choice(WORDS)),
+            u'<a href="http://x.com/%d?a=1&b=2">%s</a>' % (i, rng.choice(WORDS)),
+            u'<img src=x onerror="alert(%d)">' % i,
+            u'<span class="c_%d">%s</span>' % (i, rng.choice(WORDS)),
+            _sentence(rng, 3),
+        ]))
+    return u' '.join(parts)
+
+
+def _pathological(rng):
+    # unbalanced and deeply interleaved markers, deep nesting, and runs of
+    # brackets, backticks and link openings that are never closed
+    return rng.choice([
+        u'*a ' * 200,
+        u'_' * 400,
+        u'**a *b ' * 100,
+        u'*' + u'a_b*c ' * 100,
+        u'__a **b _c *d ' * 50,
+        u'- ' * 26 + u'a',
+        u'> ' * 4900,
+        u'[' * 9000,
+        u'[a](' * 2400,
+        u'[a](' + u'"' * 9000 + u'x)',
+        u'`' * 9000,
+        u'<http://' * 1250,
+    ])
+
+
+CORPORA = [
+    # name, generator, number of texts, converter options
+    ('chat', _chat, 500, {'safe_mode': 'escape', 'deterministic': True}),
+    ('posts', _post, 40, {'safe_mode': 'escape', 'deterministic': True}),
+    ('code blocks', _code, 60, {'safe_mode': 'escape', 'deterministic': True}),
+    ('nested lists', _lists, 60, {'safe_mode': 'escape', 'deterministic': True}),
+    ('inline html', _html, 200, {'safe_mode': 'escape', 'deterministic': True}),
+    ('pathological', _pathological, 20, {'safe_mode': 'escape', 'deterministic': True}),
+]
+
+# Converter methods timed separately; the block gamut and the span gamut
+# call each other, so only the outermost call of each is counted.
+STAGES = ['_hash_html_spans', '_hash_html_blocks', '_strip_link_definitions',
+          '_do_headers', '_do_lists', '_do_code_blocks', '_do_block_quotes',
+          '_form_paragraphs', '_run_span_gamut', '_do_code_spans',
+          '_escape_special_chars', '_do_links', '_do_auto_links',
+          '_encode_amps_and_angles', '_do_italics_and_bold',
+          '_unescape_special_chars', '_unhash_html_spans']
+
+
+def corpus(make, count, seed=0):
+    rng = random.Random(seed)
+    return [make(rng) for i in range(count)]
+
+
+#---- timing
+
+def bench(md, texts, repeat):
+    """Best wall time of `repeat` conversions of all of `texts`, in seconds."""
+    best = None
+    gc.disable()
+    try:
+        for i in range(repeat):
+            start = timeit.default_timer()
+            for text in texts:
+                md.convert(text)
+            elapsed = timeit.default_timer() - start
+            if best is None or elapsed < best:
+                best = elapsed
+    finally:
+        gc.enable()
+    return best
+
+
+def profiled(options):
+    """A converter that adds up the time spent in each of STAGES."""
+    timings = dict.fromkeys(STAGES, 0.0)
+
+    def timed(name):
+        func = getattr(Markdown, name)
+        depth = [0]
+        def wrapper(self, *args, **kwargs):
+            if depth[0]:
+                return func(self, *args, **kwargs)
+            depth[0] += 1
+            start = timeit.default_timer()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                timings[name] += timeit.default_timer() - start
+                depth[0] -= 1
+        return wrapper
+
+    cls = type('ProfiledMarkdown', (Markdown,),
+               dict((name, timed(name)) for name in STAGES))
+    return cls(**options), timings
+
+
+def reference():
+    """Time of a fixed string and regex workload that does not use the
+    converter. Times are compared with a baseline relative to it, which
+    takes out most of the difference between a slow and a fast moment of a
+    shared machine."""
+    text = u'word \u4eca\u5929 *a* ' * 500
+    start = timeit.default_timer()
+    for i in range(20):
+        re.sub(r'\*(\w+)\*', r'<em>\1</em>', text)
+        u'\n'.join(reversed(text.split(u' '))).replace(u'\n', u' <br />\n')
+    return timeit.default_timer() - start
+
+
+def run_suite(repeat):
+    """{corpus name: {'us_per_item', 'kb_per_s', 'stages'}} for CORPORA,
+    and the best time of reference()."""
+    suite = [(name, corpus(make, count), Markdown(**options))
+             for name, make, count, options in CORPORA]
+    # Round robin, so that a slow patch of the run hits every corpus.
+    best = {}
+    best_reference = None
+    for i in range(repeat):
+        best_reference = min(reference(), best_reference or sys.maxint)
+        for name, texts, md in suite:
+            best[name] = min(bench(md, texts, 1), best.get(name, sys.maxint))
+
+    results = {}
+    for name, make, count, options in CORPORA:
+        texts = corpus(make, count)
+        elapsed = best[name]
+        md, timings = profiled(options)
+        for i in range(repeat):
+            for text in texts:
+                md.convert(text)
+        chars = sum(len(text) for text in texts)
+        results[name] = {
+            'us_per_item': elapsed * 1e6 / len(texts),
+            'kb_per_s': chars / 1024.0 / elapsed,
+            'stages': dict((stage, t * 1e6 / len(texts) / repeat)
+                           for stage, t in timings.items() if t),
+        }
+    return results, best_reference
+
+
+def report(results, scale=1.0, baseline=None, tolerance=0.25, stages=False):
+    """Print `results`; return the names of corpora slower than `baseline`
+    by more than `tolerance`, once its times are multiplied by `scale`."""
+    regressions = []
+    print "%-14s %10s %9s %9s" % ("corpus", "us/item", "KB/s", "baseline")
+    for name, make, count, options in CORPORA:
+        result = results[name]
+        change = ""
+        if baseline and name in baseline:
+            before = baseline[name]['us_per_item'] * scale
+            ratio = result['us_per_item'] / before
+            change = "%+.0f%%" % ((ratio - 1) * 100)
+            if ratio > 1 + tolerance:
+                change += " SLOWER"
+                regressions.append(name)
+        print "%-14s %10.1f %9.0f %9s" % (name, result['us_per_item'],
+                                          result['kb_per_s'], change)
+        if stages:
+            for stage, us in sorted(result['stages'].items(),
+                                    key=lambda item: -item[1]):
+                print "    %-28s %10.1f" % (stage, us)
+    return regressions
+
+
+#---- placeholder scaling
+
+SCALING = [
+    # name, text for n items, converter options
+    ('html spans', lambda n: u'word <b id="%d">bold</b> <i>it</i> ' * n % tuple(range(n)),
+     {'safe_mode': 'escape'}),
+    ('link patterns', lambda n: u'@weibo%d says #%d. ' * n % tuple(range(2 * n)),
+     {'extras': ['link-patterns'],
+      'link_patterns': [(re.compile(r'@(\w+)'), r'http://weibo.com/n/\1'),
+                        (re.compile(r'#(\d+)'), r'/show/\1')]}),
+]
+
+
+def scaling(largest, repeat):
+    """Time per item as the number of placeholders in a text doubles; with
+    linear resolution it stays about flat as the text grows."""
+    print "%-14s %6s %9s %10s %8s" % ("case", "items", "chars", "ms", "us/item")
+    for name, make, options in SCALING:
+        md = Markdown(**options)
+        n = 100
+        while n <= largest:
+            text = make(n)
+            elapsed = bench(md, [text], repeat)
+            print "%-14s %6d %9d %10.1f %8.1f" % (name, n, len(text),
+                                                 elapsed * 1000, elapsed * 1e6 / n)
+            n *= 2
+
+
+#---- mainline
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="python -m utils.markdown_bench [options]")
+    parser.add_option("--repeat", type="int", default=5,
+                      help="runs per corpus, the best one counts (default 5)")
+    parser.add_option("--stages", action="store_true", default=False,
+                      help="also print the time per item in each stage")
+    parser.add_option("--save", metavar="FILE",
+                      help="write the results to FILE as a baseline")
+    parser.add_option("--baseline", metavar="FILE",
+                      help="compare with the results saved in FILE")
+    parser.add_option("--tolerance", type="float", default=0.25,
+                      help="slowdown over the baseline that fails the run "
+                           "(default 0.25, i.e. 25%)")
+    parser.add_option("--scaling", action="store_true", default=False,
+                      help="time placeholder resolution instead")
+    parser.add_option("--max", type="int", default=3200,
+                      help="with --scaling, the largest number of items "
+                           "per text (default 3200)")
+    opts, args = parser.parse_args(argv)
+
+    if opts.scaling:
+        scaling(opts.max, opts.repeat)
+        return 0
+
+    baseline = None
+    if opts.baseline:
+        f = open(opts.baseline)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+    results, reference_time = run_suite(opts.repeat)
+    if baseline:
+        regressions = report(results, reference_time / baseline['reference'],
+                             baseline['corpora'], opts.tolerance, opts.stages)
+    else:
+        regressions = report(results, stages=opts.stages)
+    if opts.save:
+        f = open(opts.save, 'w')
+        try:
+            json.dump({'python': sys.version.split()[0],
+                       'reference': reference_time, 'corpora': results},
+                      f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+    if regressions:
+        print "slower than the baseline: %s" % ", ".join(regressions)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""Offline pinyin for Chinese names.
+
+Readings come from ``pinyin.txt`` next to this module, a table of the CJK
+Unified Ideographs generated from pypinyin. It is loaded on first use.
+
+    >>> search_keys(u'\u5f20\u4e09')
+    [u'zhangsan', u'zs']
+"""
+import codecs
+import itertools
+import os
+
+TABLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pinyin.txt')
+
+# character -> toneless readings, the usual one first
+_readings = None
+
+
+def _load():
+    global _readings
+    readings = {}
+    with codecs.open(TABLE, 'r', 'utf-8') as f :
+        for line in f :
+            if line.startswith('#') :
+                continue
+            syllable, chars = line.split()
+            for char in chars :
+                readings.setdefault(char, []).append(syllable)
+    _readings = readings
+
+
+def readings(char):
+    """Toneless readings of ``char``, the usual one first; () if it has none."""
+    if _readings is None :
+        _load()
+    return _readings.get(char, ())
+
+
+def search_keys(name, limit=8):
+    """
+    Full-pinyin and initials keys of ``name``, e.g. ``zhangsan`` and ``zs``
+    for 张三. Other characters are kept as they are, lowercased; spaces are
+    dropped. Characters with several readings give several keys, at most
+    ``limit`` spellings in all. Returns [] when ``name`` has no Chinese.
+    """
+    choices = []
+    chinese = False
+    for char in name.lower() :
+        if char.isspace() :
+            continue
+        found = readings(char)
+        chinese = chinese or bool(found)
+        choices.append(found or (char,))
+    if not chinese :
+        return []
+    keys = []
+    for spelling in itertools.islice(itertools.product(*choices), limit) :
+        for key in (u''.join(spelling), u''.join(s[0] for s in spelling)) :
+            if key not in keys :
+                keys.append(key)
+    return keys
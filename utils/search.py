@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""Tokenizer for the status search index.
+
+Latin text is split into lowercased words. Chinese has no spaces, so runs
+of CJK characters are indexed as overlapping bigrams and as single
+characters: a query of two or more characters is looked up by its bigrams,
+and a one-character query by the character itself.
+
+    >>> sorted(index_tokens(u'Hello \\u4f60\\u597d\\u5417 hello').items())
+    [(u'hello', 2), (u'\\u4f60', 1), (u'\\u4f60\\u597d', 1), (u'\\u5417', 1), (u'\\u597d', 1), (u'\\u597d\\u5417', 1)]
+    >>> query_tokens(u'\\u4f60\\u597d\\u5417')
+    [u'\\u4f60\\u597d', u'\\u597d\\u5417']
+"""
+import re
+
+_token_re = re.compile(u'([\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+)|[0-9a-z\u00c0-\u024f]+')
+
+# longer words are cut, so that a pasted URL cannot make a huge key
+MAX_WORD = 32
+
+
+def _tokens(text, query):
+    if isinstance(text, str) :
+        text = text.decode('utf-8')
+    for m in _token_re.finditer(text.lower()) :
+        run = m.group(0)
+        if not m.group(1) :
+            yield run[:MAX_WORD]
+            continue
+        if len(run) == 1 or not query :
+            for char in run :
+                yield char
+        for i in range(len(run) - 1) :
+            yield run[i:i+2]
+
+
+def index_tokens(text):
+    """Tokens of a status to index, with the number of times each occurs."""
+    counts = {}
+    for token in _tokens(text, False) :
+        counts[token] = counts.get(token, 0) + 1
+    return counts
+
+
+def query_tokens(text):
+    """Distinct tokens a status must contain to match the query ``text``."""
+    tokens = []
+    for token in _tokens(text, True) :
+        if token not in tokens :
+            tokens.append(token)
+    return tokens